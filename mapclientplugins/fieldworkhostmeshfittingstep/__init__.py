@@ -22,5 +22,17 @@ __author__ = 'Ju Zhang'
 __stepname__ = 'Fieldwork Host Mesh Fitting'
 __location__ = 'https://github.com/mapclient-plugins/fieldworkhostmeshfittingstep/archive/v1.0.1.zip'
 
-from mapclientplugins.fieldworkhostmeshfittingstep import step
-import mapclientplugins.fieldworkhostmeshfittingstep.resources_rc
+import sys
+
+if 'mapclient' in sys.modules:
+    # loaded as a MAP Client plugin
+    from mapclientplugins.fieldworkhostmeshfittingstep import step
+    import mapclientplugins.fieldworkhostmeshfittingstep.resources_rc
+else:
+    # the step needs the MAP Client, Qt and mayavi, which headless use of
+    # the fitting, batch and benchmark modules does not
+    try:
+        from mapclientplugins.fieldworkhostmeshfittingstep import step
+        import mapclientplugins.fieldworkhostmeshfittingstep.resources_rc
+    except ImportError:
+        pass
@@ -0,0 +1,140 @@
+'''
+Sparse matrices of basis function values for evaluating a geometric
+field at fixed element coordinates.
+
+These assemble the same matrices as the evaluators made by
+geometric_field.makeGeometricFieldEvaluatorSparse and
+makeGeometricFieldDerivativesEvaluatorSparse, but return the matrices
+themselves so that they can be reused, e.g. to assemble Jacobians.
+Field values at the evaluation points are A.dot(P.T) where P is the
+(dimensions, number of nodes) parameter array. Matrices can be built
+for a subset of the elements, whose rows they then only have.
+'''
+from scipy import sparse
+import numpy as np
+
+
+def _flatFunction(gf):
+    f = gf.ensemble_field_function
+    if not f.is_flat():
+        f = f.flatten()[0]
+    return f
+
+
+def _elementNodes(f, elementNumber):
+    emap = f.mapper._element_to_ensemble_map[elementNumber]
+    return np.array([emap[n][0][0] for n in range(len(emap))])
+
+
+def _elementNumbers(f, elements=None):
+    """
+    Sorted element numbers of f, or of elements if given. Raises a
+    ValueError for elements that f does not have.
+    """
+    if elements is None:
+        return np.sort(list(f.mesh.elements.keys()))
+    unknown = set(elements).difference(f.mesh.elements)
+    if unknown:
+        raise ValueError('no elements {} in the mesh'.format(sorted(unknown)))
+    return np.sort(list(elements))
+
+
+def elementsNodes(gf, elements):
+    """
+    Sorted indices of the nodes of gf in elements.
+    """
+    f = _flatFunction(gf)
+    return np.unique(np.hstack([_elementNodes(f, e) for e in _elementNumbers(f, elements)]))
+
+
+def assembleMatrix(blocks, nRows, nCols):
+    """
+    Assemble a sparse matrix from a list of (row0, nodes, b) blocks where
+    b[i, n] is the value at row row0 + i and column nodes[n].
+    """
+    if not blocks:
+        return sparse.csr_matrix((nRows, nCols))
+    rows = []
+    cols = []
+    vals = []
+    for row0, nodes, b in blocks:
+        r = np.arange(row0, row0 + b.shape[0])
+        rows.append(np.repeat(r, b.shape[1]))
+        cols.append(np.tile(nodes, b.shape[0]))
+        vals.append(b.ravel())
+
+    A = sparse.coo_matrix((np.hstack(vals), (np.hstack(rows), np.hstack(cols))),
+                          shape=(nRows, nCols))
+    A.sum_duplicates()
+    A.eliminate_zeros()
+    return A.tocsr()
+
+
+def evaluationMatrix(gf, evalD, elements=None):
+    """
+    Matrix of basis values at a regular xi discretisation evalD (e.g.
+    [10,10]) of every element of gf, or of elements if given, in element
+    number order.
+    """
+    f = _flatFunction(gf)
+    basisValues = {}
+    blocks = []
+    row = 0
+    for elementNumber in _elementNumbers(f, elements):
+        element = f.mesh.elements[elementNumber]
+        b = basisValues.get(element.type)
+        if b is None:
+            evalGrid = element.generate_eval_grid(evalD).squeeze()
+            b = basisValues[element.type] = f.basis[element.type].eval(evalGrid.T).T
+
+        blocks.append((row, _elementNodes(f, elementNumber), b))
+        row += b.shape[0]
+
+    return assembleMatrix(blocks, row, f.get_number_of_ensemble_points())
+
+
+def derivativeMatrices(gf, evalD, elements=None):
+    """
+    List of matrices of basis derivative values at a regular xi
+    discretisation evalD of every element of gf, or of elements if
+    given, one matrix per derivative in the order of the basis
+    eval_derivatives function.
+    """
+    f = _flatFunction(gf)
+    basisValues = {}
+    blocks = []
+    row = 0
+    for elementNumber in _elementNumbers(f, elements):
+        element = f.mesh.elements[elementNumber]
+        b = basisValues.get(element.type)
+        if b is None:
+            evalGrid = element.generate_eval_grid(evalD)
+            b = basisValues[element.type] = f.basis[element.type].eval_derivatives(evalGrid.T, None)
+
+        blocks.append((row, _elementNodes(f, elementNumber), b))
+        row += b.shape[2]
+
+    nNodes = f.get_number_of_ensemble_points()
+    return [assembleMatrix([(r, nodes, b[d].T) for r, nodes, b in blocks], row, nNodes)
+            for d in range(blocks[0][2].shape[0])]
+
+
+def materialPointsMatrix(gf, matPoints):
+    """
+    Matrix of basis values at a list of (element number, xi) material
+    points, e.g. the slave node xi returned by host mesh fitting.
+    """
+    f = _flatFunction(gf)
+    elemNodes = {}
+    blocks = []
+    for row, (elem, xi) in enumerate(matPoints):
+        element = f.mesh.elements[elem]
+        b = f.basis[element.type].eval(xi)
+        nodes = elemNodes.get(elem)
+        if nodes is None:
+            emap = f.mapper._element_to_ensemble_map[elem]
+            nodes = elemNodes[elem] = np.array([emap[k][0][0] for k in list(emap.keys())])
+
+        blocks.append((row, nodes, np.reshape(b, (1, -1))))
+
+    return assembleMatrix(blocks, len(matPoints), f.get_number_of_ensemble_points())
@@ -0,0 +1,110 @@
+'''
+Headless batch host mesh fitting of many subjects over a process pool.
+
+Example:
+
+    jobs = [FitJob(data, slaveGF, config={'fit mode': 'EPDP'}) for data in clouds]
+    for output in fitBatch(jobs, workers=16, timeout=600.0):
+        if isinstance(output, Exception):
+            ...
+        slaveGFFitted, slaveGFParamsFitted, RMSEFitted, fitErrors, hostGFFitted = output
+'''
+from concurrent import futures
+
+from mapclientplugins.fieldworkhostmeshfittingstep import cache
+from mapclientplugins.fieldworkhostmeshfittingstep import decimation
+from mapclientplugins.fieldworkhostmeshfittingstep import fitting
+
+
+class FitJob(object):
+    '''
+    A single host mesh fitting job. config is a step-style dictionary of
+    string values; missing entries take the step defaults. If hostGF is
+    None, a host mesh of the configured type is generated around slaveGF.
+    dataWeights are optional weights for each point in data.
+
+    data and dataWeights can be given as paths of .npy files, which are
+    then memory-mapped by the process that runs the job instead of being
+    copied to it.
+    '''
+
+    def __init__(self, data, slaveGF, hostGF=None, config=None, name=None, dataWeights=None):
+        self.data = data if isinstance(data, str) else fitting.asFloatArray(data)
+        self.dataWeights = dataWeights
+        if (dataWeights is not None) and not isinstance(dataWeights, str):
+            self.dataWeights = fitting.asFloatArray(dataWeights)
+        self.slaveGF = slaveGF
+        self.hostGF = hostGF
+        self.config = dict(fitting.FIT_CONFIG_DEFAULTS)
+        if config is not None:
+            self.config.update(config)
+        self.name = name
+
+
+def runFitJob(job, timeout=None):
+    """
+    Run a single FitJob. The job's meshes are not modified. If timeout
+    is None, the job's 'timeout' config is used.
+
+    Returns slaveGFFitted, slaveGFParamsFitted, RMSEFitted, fitErrors,
+    hostGFFitted as the first five outputs of
+    FieldworkHostMeshFittingStep._fit.
+    """
+    args = fitting.parseFitConfigs(job.config)
+    if timeout is None:
+        timeout = args['timeout'] or None
+    slaveGF = cache.copyGF(job.slaveGF)
+    if job.hostGF is None:
+        hostGF = fitting.makeHostGF(slaveGF, args['host element type'])
+    else:
+        hostGF = cache.copyGF(job.hostGF)
+
+    data = fitting.asFloatArray(job.data)
+    dataWeights = None if job.dataWeights is None else fitting.asFloatArray(job.dataWeights)
+    stages = []
+    for stageArgs in args.stages:
+        fitData, fitDataWeights = decimation.decimate(
+            data, dataWeights, voxelSize=stageArgs['decimation voxel size'],
+            diskRadius=stageArgs['decimation disk radius'], verbose=stageArgs['verbose']
+        )
+        stages.append((fitData, stageArgs, None, fitDataWeights))
+
+    hostParamsOpt, slaveParamsOpt, slaveXi, RMSEFitted, fitErrors = \
+        fitting.hostMeshFitStages(stages, slaveGF, hostGF, timeout=timeout,
+                                  errorData=None if stages[-1][0] is data else data,
+                                  errorWeights=dataWeights)
+
+    return slaveGF, slaveParamsOpt.copy(), RMSEFitted, fitErrors, hostGF
+
+
+def fitBatch(jobs, workers=None, timeout=None):
+    """
+    Fit a list of FitJobs over a pool of worker processes.
+
+    workers is the number of processes, defaulting to the number of
+    cores. If workers is 1 the jobs are run in this process. timeout is
+    the wall-clock limit in seconds for each job, enforced inside the
+    worker, after which the job stops and outputs the best fit found so
+    far.
+
+    Returns a list of the outputs of runFitJob in the order of jobs. The
+    exception raised by a failed job is returned in place of its outputs.
+    """
+    results = []
+    if workers == 1:
+        for job in jobs:
+            try:
+                results.append(runFitJob(job, timeout))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        jobFutures = [executor.submit(runFitJob, job, timeout) for job in jobs]
+        for f in jobFutures:
+            try:
+                results.append(f.result())
+            except Exception as e:
+                results.append(e)
+
+    return results
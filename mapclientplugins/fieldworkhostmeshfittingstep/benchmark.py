@@ -0,0 +1,234 @@
+'''
+Benchmarks of host mesh fitting on synthetic meshes and point clouds.
+
+Each case fits a cylindrical slave mesh to points sampled on a deformed
+cylinder by running FieldworkHostMeshFittingStep._fit without its GUI,
+and records the wall time, number of objective evaluations, peak memory
+and final RMSE of the fit. Cases run one at a time, each in a new
+process so that peak memory is measured per case. Results are written
+to a JSON file, e.g.
+
+    python -m mapclientplugins.fieldworkhostmeshfittingstep.benchmark -o results.json
+    python -m mapclientplugins.fieldworkhostmeshfittingstep.benchmark --suite full \\
+        --config "analytic jacobian=True" -o results-sparse.json
+'''
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import numpy as np
+import scipy
+
+from mapclientplugins.fieldworkhostmeshfittingstep import __version__
+from mapclientplugins.fieldworkhostmeshfittingstep import fitting
+
+SUITES = {
+    'quick': {
+        'points': [10000, 100000],
+        'host element type': ['quad444', 'quad333'],
+        'fit mode': list(fitting.FIT_MODES),
+        'slave mesh discretisation': ['[10,10]'],
+        'precision': ['float64'],
+    },
+    'full': {
+        'points': [10000, 100000, 1000000, 5000000],
+        'host element type': list(fitting.HOST_ELEMENT_TYPES),
+        'fit mode': list(fitting.FIT_MODES),
+        'slave mesh discretisation': ['[5,5]', '[10,10]', '[20,20]'],
+        'precision': ['float64'],
+    },
+}
+
+SLAVE_RADIUS = 20.0
+SLAVE_HEIGHT = 40.0
+
+
+def makeSlaveMesh(nAround=8, nUp=3, radius=SLAVE_RADIUS, height=SLAVE_HEIGHT):
+    """
+    Open cylinder of nAround x nUp bicubic Lagrange elements, closed
+    around its axis.
+    """
+    from gias3.fieldwork.field import geometric_field
+    from gias3.fieldwork.field.topology import element_types
+
+    gf = geometric_field.GeometricField('slave', 3, field_dimensions=2,
+                                        field_basis={'quad44': 'quad_L3_L3'})
+    for eu in range(nUp):
+        for ea in range(nAround):
+            theta, z = np.meshgrid(np.linspace(ea, ea + 1, 4) * 2.0 * np.pi / nAround,
+                                   np.linspace(eu, eu + 1, 4) * height / nUp)
+            params = np.array([radius * np.cos(theta).ravel(),
+                               radius * np.sin(theta).ravel(),
+                               z.ravel()])[:, :, np.newaxis]
+            gf.add_element_with_parameters(element_types.create_element('quad44'), params, tol=1e-3)
+    return gf
+
+
+def makePointCloud(nPoints, radius=SLAVE_RADIUS, height=SLAVE_HEIGHT, noise=0.1, seed=0):
+    """
+    nPoints sampled on a cylinder whose cross section is stretched into
+    an oval and twisted, with gaussian noise of s.d. noise.
+    """
+    rand = np.random.RandomState(seed)
+    theta = rand.uniform(0.0, 2.0 * np.pi, nPoints)
+    z = rand.uniform(0.0, height, nPoints)
+    r = radius * (1.1 + 0.1 * np.cos(2.0 * (theta + 0.5 * z / height)))
+    points = np.array([r * np.cos(theta), r * np.sin(theta), 1.05 * z]).T
+    points += rand.normal(scale=noise, size=points.shape)
+    return points
+
+
+def _peakMemory():
+    """
+    Peak resident memory of this process in MB, or None if unknown.
+    """
+    if resource is None:
+        return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxRSS / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+def runCase(case):
+    """
+    Fit one benchmark case, a dictionary of 'points' and step configs.
+    Should be run in a new process for its peak memory to be that of
+    the case alone.
+    """
+    from mapclientplugins.fieldworkhostmeshfittingstep.step import FieldworkHostMeshFittingStep
+
+    case = dict(case)
+    nPoints = case.pop('points')
+    data = makePointCloud(nPoints)
+    slaveGF = makeSlaveMesh()
+
+    step = FieldworkHostMeshFittingStep(tempfile.gettempdir())
+    step._config.update(case)
+    step._config.update({'GUI': 'False', 'verbose': 'False', 'profile': 'True'})
+    step.setPortData(0, data)
+    step.setPortData(1, slaveGF)
+    memoryBefore = _peakMemory()
+
+    t0 = time.time()
+    step._fit()
+    wallTime = time.time() - t0
+
+    result = {'points': nPoints, 'config': case}
+    result['wall time'] = wallTime
+    result['evaluations'] = step.fitProfile['slave objective']['calls']
+    result['peak memory MB'] = _peakMemory()
+    result['memory before fit MB'] = memoryBefore
+    result['RMSE'] = float(step.RMSEFitted)
+    result['profile'] = step.fitProfile
+    return result
+
+
+def makeCases(suite, config=None, **overrides):
+    """
+    Cases of the product of the parameters of suite, with any list in
+    overrides replacing that of the suite. config holds step configs
+    common to every case.
+    """
+    params = dict(SUITES[suite])
+    params.update((k, v) for k, v in overrides.items() if v)
+    keys = ['points', 'host element type', 'fit mode', 'slave mesh discretisation', 'precision']
+    cases = []
+    for values in itertools.product(*[params[k] for k in keys]):
+        case = dict(config or {})
+        case.update(zip(keys, values))
+        cases.append(case)
+    return cases
+
+
+def environment():
+    return {
+        'package version': __version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu count': os.cpu_count(),
+        'date': datetime.datetime.now().isoformat(),
+    }
+
+
+def runBenchmarks(cases, outputPath=None, verbose=True):
+    """
+    Run each case in a new process and return the results with the
+    environment they were run in. If outputPath is given, the results
+    are written to it as JSON after each case.
+    """
+    results = {'environment': environment(), 'results': []}
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for i, case in enumerate(cases):
+            try:
+                result = pool.apply(runCase, (case,))
+            except Exception as e:
+                result = {'points': case['points'], 'config': case, 'error': repr(e)}
+            results['results'].append(result)
+            if verbose:
+                print('{}/{} {}: {}'.format(i + 1, len(cases), _caseName(case), _resultSummary(result)))
+            if outputPath is not None:
+                with open(outputPath, 'w') as f:
+                    json.dump(results, f, indent=1)
+    finally:
+        pool.terminate()
+
+    return results
+
+
+def _caseName(case):
+    return '{} points {} {} {} {}'.format(case['points'], case['host element type'], case['fit mode'],
+                                          case['slave mesh discretisation'], case['precision'])
+
+
+def _resultSummary(result):
+    if 'error' in result:
+        return result['error']
+    return '{:.2f} s, {} evaluations, {:.0f} MB, RMSE {:.4f}'.format(
+        result['wall time'], result['evaluations'], result['peak memory MB'] or 0.0, result['RMSE'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark host mesh fitting on synthetic data.')
+    parser.add_argument('--suite', choices=sorted(SUITES), default='quick',
+                        help='set of cases to run, default quick')
+    parser.add_argument('--points', type=int, nargs='+', help='numbers of target points')
+    parser.add_argument('--host', nargs='+', choices=fitting.HOST_ELEMENT_TYPES, help='host element types')
+    parser.add_argument('--mode', nargs='+', choices=fitting.FIT_MODES, help='fit modes')
+    parser.add_argument('--discretisation', nargs='+', help='slave mesh discretisations, e.g. "[10,10]"')
+    parser.add_argument('--precision', nargs='+', choices=fitting.PRECISIONS,
+                        help='precisions, float32 applies with "analytic jacobian=True"')
+    parser.add_argument('--config', nargs='+', default=[], metavar='KEY=VALUE',
+                        help='other step configs for every case, e.g. "max iterations=5"')
+    parser.add_argument('-o', '--output', default='hostmeshfitting-benchmark.json',
+                        help='JSON results file')
+    args = parser.parse_args(argv)
+
+    config = dict(kv.split('=', 1) for kv in args.config)
+    cases = makeCases(args.suite, config, **{
+        'points': args.points,
+        'host element type': args.host,
+        'fit mode': args.mode,
+        'slave mesh discretisation': args.discretisation,
+        'precision': args.precision,
+    })
+    runBenchmarks(cases, args.output)
+
+
+if __name__ == '__main__':
+    main()
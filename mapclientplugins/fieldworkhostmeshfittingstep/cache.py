@@ -0,0 +1,347 @@
+'''
+Caches for objects that are expensive to rebuild between fits.
+'''
+import copy
+import hashlib
+import os
+import pickle
+import weakref
+from collections import OrderedDict
+
+from scipy.spatial import cKDTree
+from gias3.fieldwork.field import geometric_field
+from gias3.fieldwork.field import geometric_field_fitter as GFF
+import numpy as np
+
+from mapclientplugins.fieldworkhostmeshfittingstep import basis
+
+
+def hashArray(a, *extra):
+    """
+    Return a hex digest of the contents, shape and dtype of array a and of
+    the repr of any extra key values.
+    """
+    a = np.ascontiguousarray(a)
+    h = hashlib.sha1()
+    h.update(str((a.shape, a.dtype.str, extra)).encode())
+    h.update(a.data)
+    return h.hexdigest()
+
+
+def copyGF(gf, fieldParameters=None):
+    """
+    Return a new GeometricField that shares the ensemble field function
+    (topology and basis) of gf but has its own copy of the parameters,
+    or of fieldParameters if given, and of the point counters, named
+    points and cached element xi and basis weights. This costs about as
+    much as copying the parameters, and is used in place of deepcopy
+    wherever only the parameters of a field differ. The ensemble field
+    function must not be modified afterwards.
+
+    Fields with splines or with points other than their ensemble points
+    are deep copied.
+    """
+    if fieldParameters is None:
+        fieldParameters = gf.field_parameters
+
+    if gf.splines or (len(gf.points) != gf.field_parameters.shape[1]):
+        newGF = copy.deepcopy(gf)
+    else:
+        newGF = geometric_field.GeometricField(gf.name, gf.dimensions,
+                                               ensemble_field_function=gf.ensemble_field_function)
+        newGF.ensemble_field_function_filename = gf.ensemble_field_function_filename
+        newGF.named_points_map = dict(gf.named_points_map)
+        newGF.points_counter = gf.points_counter
+        newGF.ensemble_point_counter = gf.ensemble_point_counter
+        newGF.basisWeights = copy.deepcopy(gf.basisWeights)
+        newGF.elementXis = copy.deepcopy(gf.elementXis)
+
+    newGF.set_field_parameters(fieldParameters.copy())
+    return newGF
+
+
+_topologyKeys = weakref.WeakKeyDictionary()
+
+
+def topologyKey(gf):
+    """
+    Return a hex digest of the basis, element types and element to node
+    maps of gf, which the basis matrices of gf depend on. Digests are
+    memoised per ensemble field function, so are only computed once for
+    fields that share one, e.g. copies made by copyGF.
+    """
+    eff = gf.ensemble_field_function
+    key = _topologyKeys.get(eff)
+    if key is None:
+        f = eff if eff.is_flat() else eff.flatten()[0]
+        elementMaps = f.mapper._element_to_ensemble_map
+        topology = [sorted((t, type(b).__name__) for t, b in f.basis.items())]
+        for elementNumber in sorted(f.mesh.elements):
+            topology.append((elementNumber, f.mesh.elements[elementNumber].type,
+                             sorted(elementMaps[elementNumber].items())))
+        key = _topologyKeys[eff] = hashlib.sha1(repr(topology).encode()).hexdigest()
+    return key
+
+
+def packSlaveXi(slaveXi):
+    """
+    Split slave xi, a list of [element, xi] pairs, into an array of
+    elements and an array of xi for saving.
+    """
+    return np.array([e for e, xi in slaveXi], dtype=int), np.array([xi for e, xi in slaveXi], dtype=float)
+
+
+def unpackSlaveXi(elements, xi):
+    return [[e, x] for e, x in zip(elements, xi)]
+
+
+class LRUCache(object):
+    '''
+    Dictionary-like cache that evicts the least recently used entry once
+    it holds more than maxSize entries.
+    '''
+
+    def __init__(self, maxSize=16):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Return the value for key, or None if key is not cached.
+        """
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class HostMeshCache(LRUCache):
+    '''
+    Cache of generated host meshes keyed by the slave mesh parameters,
+    host element type and padding. The cached mesh is kept as a template
+    and each call returns a new field with its own copy of the template
+    parameters, so fitting a returned host mesh never alters the cache.
+    '''
+
+    def getHostGF(self, slaveParams, hostElementType, pad):
+        key = (hashArray(slaveParams), hostElementType, float(pad))
+        template = self.get(key)
+        if template is None:
+            print('creating host mesh of type', hostElementType)
+            template = GFF.makeHostMesh(slaveParams, pad, hostElementType)
+            self.put(key, template)
+
+        return copyGF(template)
+
+
+class BasisMatrixCache(LRUCache):
+    '''
+    Cache of the sparse basis matrices of the slave mesh objectives keyed
+    by the topology of the field they are built for, their name,
+    discretisation and elements. The matrices do not depend on the field
+    parameters, so every fit of a slave mesh of the same topology shares
+    them. Cached matrices must not be modified.
+    '''
+
+    def __init__(self, maxSize=32):
+        super(BasisMatrixCache, self).__init__(maxSize)
+
+    def getMatrices(self, gf, name, evalD, build, elements=None):
+        """
+        Return build(gf, evalD, elements), built once per topology of gf.
+        elements is None for every element of gf.
+        """
+        key = (topologyKey(gf), name, repr(evalD), None if elements is None else tuple(elements))
+        matrices = self.get(key)
+        if matrices is None:
+            matrices = build(gf, evalD, elements)
+            self.put(key, matrices)
+
+        return matrices
+
+
+class EmbeddingCache(LRUCache):
+    '''
+    Cache of the embedding of slave mesh nodes in host meshes: the host
+    element xi of each slave node, keyed by the host mesh topology and
+    parameters and the slave node coordinates, and the matrix of host
+    basis values at those xi, keyed by the host topology and the xi.
+    Refits of a slave mesh in the same host mesh, e.g. every subject
+    fitted with the same template, search for the slave nodes once.
+    '''
+
+    def __init__(self, maxSize=8):
+        super(EmbeddingCache, self).__init__(maxSize)
+
+    def getSlaveXi(self, hostGF, slaveParams):
+        """
+        Return the host element xi of the slave nodes slaveParams, as a
+        list of [element, xi] pairs.
+        """
+        key = ('xi', topologyKey(hostGF), hashArray(hostGF.field_parameters), hashArray(slaveParams))
+        slaveXi = self.get(key)
+        if slaveXi is None:
+            slaveXi = hostGF.find_closest_material_points(slaveParams[:, :, 0].T,
+                                                          init_gd=[40, 40, 40], verbose=False)[0]
+            self.put(key, slaveXi)
+
+        return slaveXi
+
+    def getMatrix(self, hostGF, slaveXi):
+        """
+        Return the matrix of hostGF basis values at slaveXi.
+        """
+        elements, xi = packSlaveXi(slaveXi)
+        key = ('matrix', topologyKey(hostGF), hashArray(elements), hashArray(xi))
+        E = self.get(key)
+        if E is None:
+            E = basis.materialPointsMatrix(hostGF, slaveXi)
+            self.put(key, E)
+
+        return E
+
+
+class KDTreeCache(LRUCache):
+    '''
+    Cache of KD-trees over target point clouds keyed by a hash of the
+    point coordinates and the tree leaf size. If a cacheDir is given,
+    trees are also saved to and loaded from that directory so that they
+    persist between sessions.
+    '''
+
+    def __init__(self, maxSize=2):
+        super(KDTreeCache, self).__init__(maxSize)
+
+    def getTree(self, data, leafsize=16, cacheDir=None):
+        key = hashArray(data, leafsize)
+        tree = self.get(key)
+        if tree is None:
+            tree = self._load(key, cacheDir)
+            if tree is None:
+                tree = cKDTree(data, leafsize)
+                self._save(key, tree, cacheDir)
+            self.put(key, tree)
+
+        return tree
+
+    def _path(self, key, cacheDir):
+        return os.path.join(cacheDir, 'kdtree-{}.pkl'.format(key))
+
+    def _load(self, key, cacheDir):
+        if cacheDir is None:
+            return None
+        try:
+            with open(self._path(key, cacheDir), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _save(self, key, tree, cacheDir):
+        if cacheDir is None:
+            return
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        # write then rename so that an interrupted save is never loaded
+        path = self._path(key, cacheDir)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+
+class FitResultCache(object):
+    '''
+    On-disk cache of fit results keyed by a hash of everything that
+    determines them, see key. Each result is saved in cacheDir as an
+    uncompressed NumPy .npz file of its arrays, and once the results in
+    cacheDir take more than maxSize bytes the least recently used are
+    deleted.
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(hashes, config):
+        """
+        Return a hex digest of a list of hashArray digests of the fit
+        inputs, any of which may be None, and of the repr of config.
+        """
+        return hashlib.sha1(repr((list(hashes), config)).encode()).hexdigest()
+
+    def _path(self, key, cacheDir):
+        return os.path.join(cacheDir, 'fit-{}.npz'.format(key))
+
+    def load(self, key, cacheDir):
+        """
+        Return a dictionary of the arrays of the result saved for key,
+        or None if there is none.
+        """
+        path = self._path(key, cacheDir)
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                result = dict(f.items())
+        except (OSError, ValueError, KeyError, EOFError):
+            self.misses += 1
+            return None
+
+        # mark as recently used for eviction
+        os.utime(path, None)
+        self.hits += 1
+        return result
+
+    def save(self, key, result, cacheDir, maxSize):
+        """
+        Save result, a dictionary of arrays, for key, then delete least
+        recently used results until those in cacheDir take at most
+        maxSize bytes.
+        """
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        path = self._path(key, cacheDir)
+        # write then rename so that an interrupted save is never loaded
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **result)
+        os.replace(path + '.tmp', path)
+        self._evict(cacheDir, maxSize)
+
+    def _evict(self, cacheDir, maxSize):
+        files = []
+        for name in os.listdir(cacheDir):
+            if name.startswith('fit-') and name.endswith('.npz'):
+                stat = os.stat(os.path.join(cacheDir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(f[1] for f in files)
+        for mtime, fileSize, name in sorted(files):
+            if size <= maxSize:
+                break
+            os.remove(os.path.join(cacheDir, name))
+            size -= fileSize
+
+
+hostMeshCache = HostMeshCache()
+basisMatrixCache = BasisMatrixCache()
+embeddingCache = EmbeddingCache()
+kdTreeCache = KDTreeCache()
+fitResultCache = FitResultCache()
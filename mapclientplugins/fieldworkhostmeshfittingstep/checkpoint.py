@@ -0,0 +1,92 @@
+'''
+Checkpoints of long host mesh fits, so that a fit interrupted by a crash
+or a pre-empted batch node can be resumed from its last completed outer
+iteration instead of from the initial host mesh.
+'''
+import os
+
+import numpy as np
+
+from mapclientplugins.fieldworkhostmeshfittingstep import cache
+
+
+class FitCheckpoint(object):
+    '''
+    Progress of a host mesh fit, saved to path as a NumPy .npz file after
+    each outer iteration. stage and iteration are the fit stage and the
+    number of outer iterations of that stage completed, with the best
+    host and slave parameters reached by then and slave xi. RMSEHistory
+    holds the RMS data fitting error of the best parameters after every
+    iteration of every stage.
+
+    The path should be unique to the inputs and configs of the fit, e.g.
+    by including a FitResultCache key, as a checkpoint is resumed by any
+    fit that uses it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.stage = 0
+        self.iteration = 0
+        self.hostParams = None
+        self.slaveParams = None
+        self.slaveXi = None
+        self.RMSEHistory = []
+
+    def load(self):
+        """
+        Load the checkpoint saved at path, if any. Returns True if the
+        fit can resume from it.
+        """
+        try:
+            with np.load(self.path, allow_pickle=False) as f:
+                self.stage = int(f['stage'])
+                self.iteration = int(f['iteration'])
+                self.hostParams = f['hostParams']
+                self.slaveParams = f['slaveParams']
+                self.slaveXi = cache.unpackSlaveXi(f['slaveXiElements'], f['slaveXi'])
+                self.RMSEHistory = f['RMSEHistory'].tolist()
+        except (OSError, ValueError, KeyError, EOFError):
+            return False
+        return True
+
+    def startStage(self, stage):
+        """
+        Start counting the iterations of stage, unless it is the stage
+        being resumed.
+        """
+        if stage != self.stage:
+            self.stage = stage
+            self.iteration = 0
+
+    def update(self, iteration, hostParams, slaveParams, slaveXi, RMSE):
+        """
+        Record that iteration outer iterations of the current stage are
+        complete and save the checkpoint.
+        """
+        self.iteration = iteration
+        self.hostParams = hostParams
+        self.slaveParams = slaveParams
+        self.slaveXi = slaveXi
+        self.RMSEHistory.append(RMSE)
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        slaveXiElements, slaveXi = cache.packSlaveXi(self.slaveXi)
+        # write then rename so that a checkpoint interrupted while saving
+        # never replaces the previous one
+        with open(self.path + '.tmp', 'wb') as f:
+            np.savez(f, stage=self.stage, iteration=self.iteration, hostParams=self.hostParams,
+                     slaveParams=self.slaveParams, slaveXiElements=slaveXiElements, slaveXi=slaveXi,
+                     RMSEHistory=np.array(self.RMSEHistory, dtype=float))
+        os.replace(self.path + '.tmp', self.path)
+
+    def remove(self):
+        """
+        Delete the saved checkpoint, e.g. once the fit has completed.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
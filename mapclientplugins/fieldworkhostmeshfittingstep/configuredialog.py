@@ -1,4 +1,6 @@
 from PySide6 import QtWidgets
+
+from mapclientplugins.fieldworkhostmeshfittingstep import fitting
 from mapclientplugins.fieldworkhostmeshfittingstep.ui_configuredialog import Ui_ConfigureDialog
 
 INVALID_STYLE_SHEET = 'background-color: rgba(239, 0, 0, 50)'
@@ -27,10 +29,43 @@ class ConfigureDialog(QtWidgets.QDialog):
         # We will use this method to decide whether the identifier is unique.
         self.identifierOccursCount = None
 
+        # line edits of the fit configs validated by fitting.FitConfig
+        self._fitConfigLineEdits = {
+            'fit mode': self._ui.lineEdit2,
+            'host element type': self._ui.lineEdit3,
+            'slave mesh discretisation': self._ui.lineEdit4,
+            'slave sobelov discretisation': self._ui.lineEdit5,
+            'slave sobelov weight': self._ui.lineEdit6,
+            'slave normal discretisation': self._ui.lineEdit7,
+            'slave normal weight': self._ui.lineEdit8,
+            'max iterations': self._ui.lineEdit9,
+            'host sobelov discretisation': self._ui.lineEdit10,
+            'host sobelov weight': self._ui.lineEdit11,
+            'n closest points': self._ui.lineEdit12,
+            'kdtree args': self._ui.lineEdit13,
+            'verbose': self._ui.lineEdit14,
+            'warm start': self._ui.lineEdit15,
+            'kdtree cache': self._ui.lineEdit16,
+            'analytic jacobian': self._ui.lineEdit17,
+            'timeout': self._ui.lineEdit18,
+            'decimation voxel size': self._ui.lineEdit19,
+            'decimation disk radius': self._ui.lineEdit20,
+            'profile': self._ui.lineEdit21,
+            'result cache size': self._ui.lineEdit22,
+            'checkpoint': self._ui.lineEdit23,
+            'precision': self._ui.lineEdit24,
+            'query workers': self._ui.lineEdit25,
+            'trim fraction': self._ui.lineEdit26,
+            'trim MAD': self._ui.lineEdit27,
+            'fit elements': self._ui.lineEdit28,
+        }
+
         self._makeConnections()
 
     def _makeConnections(self):
         self._ui.lineEdit0.textChanged.connect(self.validate)
+        for lineEdit in self._fitConfigLineEdits.values():
+            lineEdit.textChanged.connect(self.validate)
 
     def accept(self):
         '''
@@ -62,6 +97,35 @@ class ConfigureDialog(QtWidgets.QDialog):
         else:
             self._ui.lineEdit0.setStyleSheet(INVALID_STYLE_SHEET)
 
+        # fit configs are checked one at a time against the defaults so
+        # that every invalid value is marked,
+        for key, lineEdit in self._fitConfigLineEdits.items():
+            config = dict(fitting.FIT_CONFIG_DEFAULTS)
+            config[key] = lineEdit.text()
+            if key == 'fit elements':
+                # needs the analytic jacobian or ICP, which is checked
+                # with the other configs below
+                config['analytic jacobian'] = 'True'
+            try:
+                fitting.FitConfig(config)
+            except fitting.FitConfigError as e:
+                lineEdit.setStyleSheet(INVALID_STYLE_SHEET)
+                lineEdit.setToolTip(str(e))
+                valid = False
+            else:
+                lineEdit.setStyleSheet(DEFAULT_STYLE_SHEET)
+                lineEdit.setToolTip('')
+
+        # then together, e.g. for the number of fit schedule stages or
+        # fit elements without the analytic jacobian
+        config = dict((key, lineEdit.text()) for key, lineEdit in self._fitConfigLineEdits.items())
+        try:
+            fitting.FitConfig(config)
+        except fitting.FitConfigError as e:
+            self._fitConfigLineEdits[e.key].setStyleSheet(INVALID_STYLE_SHEET)
+            self._fitConfigLineEdits[e.key].setToolTip(str(e))
+            valid = False
+
         return valid
 
     def getConfig(self):
@@ -87,6 +151,20 @@ class ConfigureDialog(QtWidgets.QDialog):
         config['n closest points'] = self._ui.lineEdit12.text()
         config['kdtree args'] = self._ui.lineEdit13.text()
         config['verbose'] = self._ui.lineEdit14.text()
+        config['warm start'] = self._ui.lineEdit15.text()
+        config['kdtree cache'] = self._ui.lineEdit16.text()
+        config['analytic jacobian'] = self._ui.lineEdit17.text()
+        config['timeout'] = self._ui.lineEdit18.text()
+        config['decimation voxel size'] = self._ui.lineEdit19.text()
+        config['decimation disk radius'] = self._ui.lineEdit20.text()
+        config['profile'] = self._ui.lineEdit21.text()
+        config['result cache size'] = self._ui.lineEdit22.text()
+        config['checkpoint'] = self._ui.lineEdit23.text()
+        config['precision'] = self._ui.lineEdit24.text()
+        config['query workers'] = self._ui.lineEdit25.text()
+        config['trim fraction'] = self._ui.lineEdit26.text()
+        config['trim MAD'] = self._ui.lineEdit27.text()
+        config['fit elements'] = self._ui.lineEdit28.text()
         return config
 
     def setConfig(self, config):
@@ -111,3 +189,17 @@ class ConfigureDialog(QtWidgets.QDialog):
         self._ui.lineEdit12.setText(config['n closest points'])
         self._ui.lineEdit13.setText(config['kdtree args'])
         self._ui.lineEdit14.setText(config['verbose'])
+        self._ui.lineEdit15.setText(config['warm start'])
+        self._ui.lineEdit16.setText(config['kdtree cache'])
+        self._ui.lineEdit17.setText(config['analytic jacobian'])
+        self._ui.lineEdit18.setText(config['timeout'])
+        self._ui.lineEdit19.setText(config['decimation voxel size'])
+        self._ui.lineEdit20.setText(config['decimation disk radius'])
+        self._ui.lineEdit21.setText(config['profile'])
+        self._ui.lineEdit22.setText(config['result cache size'])
+        self._ui.lineEdit23.setText(config['checkpoint'])
+        self._ui.lineEdit24.setText(config['precision'])
+        self._ui.lineEdit25.setText(config['query workers'])
+        self._ui.lineEdit26.setText(config['trim fraction'])
+        self._ui.lineEdit27.setText(config['trim MAD'])
+        self._ui.lineEdit28.setText(config['fit elements'])
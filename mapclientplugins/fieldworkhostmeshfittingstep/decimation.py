@@ -0,0 +1,122 @@
+'''
+Decimation of dense target point clouds before fitting.
+
+Closest point searches scale with the number of target points, and
+scanner point clouds are usually far denser than the slave mesh
+discretisation can resolve. Points are first averaged over a regular
+voxel grid and optionally thinned further by Poisson-disk subsampling.
+Data weights are summed over the points each kept point replaces, so
+that a kept point counts as much in the fit as the points it replaces.
+Without data weights every point has weight 1, so decimated points are
+weighted by the number of points they replace. Points of zero weight
+are dropped before decimating.
+'''
+import time
+
+from scipy.spatial import cKDTree
+import numpy as np
+
+
+def voxelGridDecimate(data, voxelSize, weights=None):
+    """
+    Replace the points in each cubic voxel of side voxelSize by their
+    mean. Returns the decimated points and the summed weights of the
+    points in each voxel (None if weights is None).
+    """
+    data = np.asarray(data, dtype=float)
+    ijk = np.floor((data - data.min(0)) / voxelSize).astype(np.int64)
+    dims = ijk.max(0) + 1
+    keys = ijk[:, 0] + dims[0] * (ijk[:, 1] + dims[1] * ijk[:, 2])
+    keys, voxel = np.unique(keys, return_inverse=True)
+    voxel = voxel.ravel()
+
+    counts = np.bincount(voxel, minlength=len(keys)).astype(float)
+    points = np.empty((len(keys), 3))
+    for d in range(3):
+        points[:, d] = np.bincount(voxel, weights=data[:, d], minlength=len(keys)) / counts
+
+    if weights is None:
+        return points, None
+    return points, np.bincount(voxel, weights=weights, minlength=len(keys))
+
+
+def poissonDiskDecimate(data, radius, weights=None, seed=0):
+    """
+    Keep a subset of points no two of which are closer than radius,
+    chosen greedily in a random order. The weight of each removed point
+    is added to that of its closest kept point. Returns the kept points
+    and their weights (None if weights is None).
+    """
+    data = np.asarray(data, dtype=float)
+    tree = cKDTree(data)
+    removed = np.zeros(len(data), dtype=bool)
+    keep = []
+    for i in np.random.RandomState(seed).permutation(len(data)):
+        if not removed[i]:
+            keep.append(i)
+            removed[tree.query_ball_point(data[i], radius)] = True
+
+    points = data[np.sort(keep)]
+    if weights is None:
+        return points, None
+
+    closest = cKDTree(points).query(data)[1]
+    return points, np.bincount(closest, weights=weights, minlength=len(points))
+
+
+def checkWeights(weights, nData=None):
+    """
+    Raise a ValueError if weights are not one weight per data point,
+    when the number of points nData is given, or if any weight is
+    negative or every weight is 0.
+    """
+    if (nData is not None) and (len(weights) != nData):
+        raise ValueError('{} data weights for {} data points'.format(len(weights), nData))
+    if (weights < 0.0).any():
+        raise ValueError('data weights must not be negative')
+    if not (weights > 0.0).any():
+        raise ValueError('every data weight is 0, so there are no points to fit')
+
+
+def dropZeroWeights(data, weights):
+    """
+    Return data and weights without the points of zero weight, or data
+    and weights themselves if no weight is zero. Raises a ValueError if
+    the weights are invalid, see checkWeights.
+    """
+    if weights is None:
+        return data, weights
+    checkWeights(weights, len(data))
+    keep = weights > 0.0
+    if not keep.all():
+        data, weights = data[keep], weights[keep]
+    return data, weights
+
+
+def decimate(data, weights=None, voxelSize=0.0, diskRadius=0.0, verbose=True):
+    """
+    Voxel grid decimation with voxelSize followed by Poisson-disk
+    decimation with diskRadius, after dropping points of zero weight.
+    Either stage is skipped if its size is 0. Returns the decimated
+    points and weights, which are the summed weights, or numbers, of
+    the points each replaces. Without decimation, weights are returned
+    as given.
+    """
+    data, weights = dropZeroWeights(data, weights)
+    if (voxelSize <= 0.0) and (diskRadius <= 0.0):
+        return data, weights
+    if weights is None:
+        weights = np.ones(len(data))
+
+    t0 = time.time()
+    nIn = len(data)
+    if voxelSize > 0.0:
+        data, weights = voxelGridDecimate(data, voxelSize, weights)
+    if diskRadius > 0.0:
+        data, weights = poissonDiskDecimate(data, diskRadius, weights)
+
+    if verbose:
+        print('decimation kept {} of {} points in {:.2f} s, {:.1f}x fewer closest point queries'.format(
+            len(data), nIn, time.time() - t0, float(nIn) / len(data)))
+
+    return data, weights
@@ -0,0 +1,1008 @@
+'''
+Host mesh fitting functions that do not depend on step instance state
+or on Qt, so that they can be used by the step, its GUI and headless
+batch runs alike.
+'''
+import ast
+import threading
+import time
+
+from scipy import sparse
+from scipy.optimize import least_squares
+from scipy.sparse.linalg import LinearOperator
+from gias3.fieldwork.field.tools import fitting_tools
+from gias3.fieldwork.field import geometric_field_fitter as GFF
+import numpy as np
+
+from mapclientplugins.fieldworkhostmeshfittingstep import basis
+from mapclientplugins.fieldworkhostmeshfittingstep import cache
+from mapclientplugins.fieldworkhostmeshfittingstep import decimation
+from mapclientplugins.fieldworkhostmeshfittingstep import objectives
+
+HOST_MESH_PAD = 5.0
+FIT_MODES = ('DPEP', 'EPDP', '2way', 'ICP')
+HOST_ELEMENT_TYPES = ('quad333', 'quad444', 'quad555')
+PRECISIONS = ('float64', 'float32')
+# objective evaluations allowed per max iteration by hostMeshFitSparse
+SPARSE_EVALS_PER_ITERATION = 10
+# singular values of the hostMeshFitICP normal equations below this
+# fraction of the largest are cut, so that host parameters the data
+# barely constrain, e.g. far from the fit elements, take no step
+ICP_RCOND = 1e-10
+# outer iterations run by hostMeshFitICP with max iterations 0, unless
+# it converges first
+ICP_MAX_ITERATIONS = 100
+# Levenberg-Marquardt damping of the hostMeshFitICP steps: the damping
+# first tried after an undamped step is rejected, the factor by which it
+# grows after each rejected step and shrinks after each accepted one, and
+# the number of steps tried per outer iteration before the fit stops
+ICP_DAMPING = 1e-3
+ICP_DAMPING_FACTOR = 10.0
+ICP_MAX_STEP_TRIALS = 10
+# relative weights of the host mesh Sobolev terms, as in hostMeshFitMulti
+HOST_SOBOLEV_WEIGHTS = np.array([1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 3.0])
+
+FIT_CONFIG_DEFAULTS = {}
+FIT_CONFIG_DEFAULTS['fit mode'] = 'DPEP'
+FIT_CONFIG_DEFAULTS['host element type'] = 'quad444'
+FIT_CONFIG_DEFAULTS['slave mesh discretisation'] = '[10,10]'
+FIT_CONFIG_DEFAULTS['slave sobelov discretisation'] = '[8,8]'
+FIT_CONFIG_DEFAULTS['slave sobelov weight'] = '[1e-6, 1e-6, 1e-6, 1e-6, 2e-6]'
+FIT_CONFIG_DEFAULTS['slave normal discretisation'] = '8'
+FIT_CONFIG_DEFAULTS['slave normal weight'] = '50.0'
+FIT_CONFIG_DEFAULTS['max iterations'] = '10'
+FIT_CONFIG_DEFAULTS['host sobelov discretisation'] = '[8,8,8]'
+FIT_CONFIG_DEFAULTS['host sobelov weight'] = '1e-5'
+FIT_CONFIG_DEFAULTS['n closest points'] = '1'
+FIT_CONFIG_DEFAULTS['kdtree args'] = '{}'
+FIT_CONFIG_DEFAULTS['query workers'] = '1'
+FIT_CONFIG_DEFAULTS['trim fraction'] = '0'
+FIT_CONFIG_DEFAULTS['trim MAD'] = '0'
+FIT_CONFIG_DEFAULTS['verbose'] = 'True'
+FIT_CONFIG_DEFAULTS['warm start'] = 'False'
+FIT_CONFIG_DEFAULTS['kdtree cache'] = 'False'
+FIT_CONFIG_DEFAULTS['analytic jacobian'] = 'False'
+FIT_CONFIG_DEFAULTS['timeout'] = '0'
+FIT_CONFIG_DEFAULTS['decimation voxel size'] = '0'
+FIT_CONFIG_DEFAULTS['decimation disk radius'] = '0'
+FIT_CONFIG_DEFAULTS['profile'] = 'False'
+FIT_CONFIG_DEFAULTS['result cache size'] = '0'
+FIT_CONFIG_DEFAULTS['checkpoint'] = 'False'
+FIT_CONFIG_DEFAULTS['precision'] = 'float64'
+FIT_CONFIG_DEFAULTS['fit elements'] = '[]'
+
+# configs that can be given per stage of a coarse-to-fine schedule
+SCHEDULE_KEYS = ('slave mesh discretisation', 'max iterations', 'decimation voxel size',
+                 'decimation disk radius')
+# configs that do not change the result of a fit, see resultConfig
+RESULT_INDEPENDENT_KEYS = ('verbose', 'warm start', 'kdtree cache', 'timeout', 'profile',
+                           'result cache size', 'checkpoint', 'query workers')
+
+
+class FitCancelledError(RuntimeError):
+    pass
+
+
+class FitTimeoutError(FitCancelledError):
+    pass
+
+
+class CancelToken(object):
+    '''
+    Cooperative cancellation of a running fit. The token is checked
+    before every objective evaluation, and the fit stops at the first
+    check after cancel() has been called from any thread or after the
+    token's timeout (seconds) has passed.
+    '''
+
+    def __init__(self, timeout=None):
+        self._cancelled = threading.Event()
+        self.deadline = None
+        if timeout is not None:
+            self.setTimeout(timeout)
+
+    def setTimeout(self, timeout):
+        """
+        Cancel the fit timeout seconds from now.
+        """
+        self.deadline = time.time() + timeout
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def isCancelled(self):
+        return self._cancelled.is_set() or self.isTimedOut()
+
+    def isTimedOut(self):
+        return (self.deadline is not None) and (time.time() > self.deadline)
+
+    def check(self):
+        """
+        Raise a FitCancelledError, or a FitTimeoutError if the timeout
+        has passed, if the fit should stop.
+        """
+        if self._cancelled.is_set():
+            raise FitCancelledError('host mesh fit cancelled')
+        if self.isTimedOut():
+            raise FitTimeoutError('host mesh fit exceeded its time limit')
+
+
+class ObjectiveMonitor(object):
+    '''
+    Wraps an objectives.SlaveObjective to keep track of the best slave
+    parameters evaluated during a fit, to report progress and to stop
+    the fit when cancelToken is cancelled.
+
+    If callback is given, it is called as callback(nEvals, slaveParams,
+    hostParams, RMSE) each time an evaluation improves on the lowest
+    objective value so far, where hostParams are those of hostGF at the
+    time of the evaluation and RMSE is the RMS data fitting error.
+
+    If profile is given, each evaluation of slaveObj and of its Jacobian
+    is recorded in it as 'slave objective' and 'jacobian', and the time
+    between evaluations, spent in the host mesh solver, as 'solver'.
+
+    If iterationCallback is given, it is called as
+    iterationCallback(iteration, slaveParams, hostParams, RMSE) with the
+    best parameters evaluated so far after every evalsPerIteration
+    evaluations, the number the solver is allowed per max iteration.
+    The current evaluation may be a finite difference probe or a
+    rejected trial step, so is not used.
+
+    Solvers that accept or reject their own steps, such as
+    hostMeshFitICP, set evalsPerIteration to None and report the
+    parameters they accept with iterationDone instead, as their
+    objective is not the mean of the slave residuals.
+    '''
+
+    def __init__(self, slaveObj, hostGF, callback=None, cancelToken=None, profile=None,
+                 iterationCallback=None, evalsPerIteration=1):
+        self.slaveObj = slaveObj
+        self.hostGF = hostGF
+        self.callback = callback
+        self.cancelToken = cancelToken
+        self.profile = profile
+        self.iterationCallback = iterationCallback
+        self.evalsPerIteration = evalsPerIteration
+        self.nEvals = 0
+        self.bestCost = np.inf
+        self.bestSlaveParams = None
+        self.bestHostParams = None
+        self.bestRMSE = None
+        self.nIterations = 0
+        self._tReturn = None
+
+    def __call__(self, x):
+        if self.cancelToken is not None:
+            self.cancelToken.check()
+
+        if self.profile is None:
+            err = self.slaveObj(x)
+        else:
+            t0 = time.perf_counter()
+            if self._tReturn is not None:
+                self.profile.record('solver', t0 - self._tReturn)
+            err = self.slaveObj(x)
+            self._tReturn = time.perf_counter()
+            self.profile.record('slave objective', self._tReturn - t0, err)
+        self.nEvals += 1
+        if self.evalsPerIteration is None:
+            # the solver reports its best parameters, see iterationDone
+            return err
+
+        cost = err.mean()
+        if cost < self.bestCost:
+            self.bestCost = cost
+            self.bestSlaveParams = np.reshape(x, (3, -1, 1)).copy()
+            self.bestHostParams = self.hostGF.get_field_parameters().copy()
+            self.bestRMSE = self.dataRMSE()
+            if self.callback is not None:
+                self.callback(self.nEvals, self.bestSlaveParams, self.bestHostParams, self.bestRMSE)
+
+        if (self.iterationCallback is not None) and (self.nEvals % self.evalsPerIteration == 0):
+            self.iterationCallback(self.nEvals // self.evalsPerIteration, self.bestSlaveParams,
+                                   self.bestHostParams, self.bestRMSE)
+
+        return err
+
+    def iterationDone(self, x):
+        """
+        Record the slave parameters x, which must be those last evaluated,
+        and the current host parameters as the best so far at the end of
+        an outer iteration, and report them to callback and
+        iterationCallback. For evalsPerIteration None.
+        """
+        self.nIterations += 1
+        self.bestSlaveParams = np.reshape(x, (3, -1, 1)).copy()
+        self.bestHostParams = self.hostGF.get_field_parameters().copy()
+        self.bestRMSE = self.dataRMSE()
+        if self.callback is not None:
+            self.callback(self.nEvals, self.bestSlaveParams, self.bestHostParams, self.bestRMSE)
+        if self.iterationCallback is not None:
+            self.iterationCallback(self.nIterations, self.bestSlaveParams, self.bestHostParams,
+                                   self.bestRMSE)
+
+    def dataRMSE(self):
+        """
+        RMS data fitting error of the last evaluation.
+        """
+        err = self.slaveObj.terms()['data']
+        w = self.slaveObj.dataObj.residualWeights
+        inliers = self.slaveObj.dataObj.inliers
+        if inliers is not None:
+            err = err[inliers]
+            w = None if w is None else w[inliers]
+        if w is None:
+            return np.sqrt(err.mean())
+        # weighted residuals are sqrt(w) times the squared distances
+        return np.sqrt((np.sqrt(w) * err).sum() / w.sum())
+
+    def jacobian(self, x):
+        if self.profile is None:
+            return self.slaveObj.jacobian(x)
+        t0 = time.perf_counter()
+        if self._tReturn is not None:
+            self.profile.record('solver', t0 - self._tReturn)
+        J = self.slaveObj.jacobian(x)
+        self._tReturn = time.perf_counter()
+        self.profile.record('jacobian', self._tReturn - t0)
+        return J
+
+
+class FitConfigError(ValueError):
+    '''
+    An invalid fit config value. key is the config key of the value.
+    '''
+
+    def __init__(self, key, value, reason):
+        ValueError.__init__(self, 'invalid {} "{}": {}'.format(key, value, reason))
+        self.key = key
+        self.value = value
+        self.reason = reason
+
+    def __reduce__(self):
+        # pickled with the constructor arguments, e.g. to be returned
+        # from a batch worker process
+        return (FitConfigError, (self.key, self.value, self.reason))
+
+
+def _literal(config, key):
+    try:
+        return ast.literal_eval(config[key].strip())
+    except (ValueError, SyntaxError):
+        raise FitConfigError(key, config[key], 'not a number, list or dictionary')
+
+
+def _bool(config, key):
+    if config[key] not in ('True', 'False'):
+        raise FitConfigError(key, config[key], 'must be True or False')
+    return config[key] == 'True'
+
+
+def _choice(config, key, choices):
+    if config[key] not in choices:
+        raise FitConfigError(key, config[key], 'must be one of ' + ', '.join(choices))
+    return config[key]
+
+
+def _number(config, key, value, minimum=0.0, integer=False):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            (integer and not isinstance(value, int)):
+        raise FitConfigError(key, config[key], 'must be ' + ('an integer' if integer else 'a number'))
+    if value < minimum:
+        raise FitConfigError(key, config[key], 'must be at least {}'.format(minimum))
+    return value
+
+
+def _numbers(config, key, value, length, minimum=0.0, integer=False):
+    if not isinstance(value, (list, tuple)) or (len(value) != length):
+        raise FitConfigError(key, config[key], 'must be a list of {} values'.format(length))
+    return [_number(config, key, v, minimum, integer) for v in value]
+
+
+def _scheduled(config, key, parse):
+    """
+    Parse a config that can be a single value or a list with one value
+    per fit stage, where parse(value) parses a single value.
+    """
+    value = _literal(config, key)
+    if isinstance(value, (list, tuple)) and len(value) and \
+            ((key != 'slave mesh discretisation') or isinstance(value[0], (list, tuple))):
+        return [parse(v) for v in value]
+    return parse(value)
+
+
+class FitConfig(dict):
+    '''
+    Fit configs parsed from a step-style dictionary of string values and
+    validated. Values are accessed by config key as before, e.g.
+    args['max iterations'], and are converted to their types once, with
+    weights as arrays. stages holds the args of each stage of a
+    coarse-to-fine schedule, see scheduleArgs.
+
+    Raises a FitConfigError for the first invalid value. FitConfigs are
+    shared between fits by parseFitConfigs and must not be modified.
+    '''
+
+    def __init__(self, config):
+        dict.__init__(self)
+        self['fit mode'] = _choice(config, 'fit mode', FIT_MODES)
+        self['verbose'] = _bool(config, 'verbose')
+        self['host element type'] = _choice(config, 'host element type', HOST_ELEMENT_TYPES)
+        self['slave mesh discretisation'] = _scheduled(
+            config, 'slave mesh discretisation',
+            lambda v: _numbers(config, 'slave mesh discretisation', v, 2, 1, True))
+        self['slave sobelov discretisation'] = _numbers(
+            config, 'slave sobelov discretisation', _literal(config, 'slave sobelov discretisation'), 2, 1, True)
+        self['slave sobelov weight'] = np.array(_numbers(
+            config, 'slave sobelov weight', _literal(config, 'slave sobelov weight'), 5), dtype=float)
+        self['slave normal discretisation'] = _number(
+            config, 'slave normal discretisation', _literal(config, 'slave normal discretisation'), 1, True)
+        self['slave normal weight'] = float(_number(
+            config, 'slave normal weight', _literal(config, 'slave normal weight')))
+        self['host sobelov discretisation'] = _numbers(
+            config, 'host sobelov discretisation', _literal(config, 'host sobelov discretisation'), 3, 1, True)
+        self['host sobelov weight'] = float(_number(
+            config, 'host sobelov weight', _literal(config, 'host sobelov weight')))
+        self['max iterations'] = _scheduled(
+            config, 'max iterations', lambda v: _number(config, 'max iterations', v, 0, True))
+        self['n closest points'] = _number(
+            config, 'n closest points', _literal(config, 'n closest points'), 1, True)
+        self['kdtree args'] = _literal(config, 'kdtree args')
+        if not isinstance(self['kdtree args'], dict):
+            raise FitConfigError('kdtree args', config['kdtree args'], 'must be a dictionary')
+        # 0 for every core, as -1 for cKDTree.query
+        self['query workers'] = _number(
+            config, 'query workers', _literal(config, 'query workers'), 0, True) or -1
+        self['trim fraction'] = float(_number(config, 'trim fraction', _literal(config, 'trim fraction')))
+        if self['trim fraction'] >= 1.0:
+            raise FitConfigError('trim fraction', config['trim fraction'], 'must be less than 1')
+        self['trim MAD'] = float(_number(config, 'trim MAD', _literal(config, 'trim MAD')))
+        self['warm start'] = _bool(config, 'warm start')
+        self['kdtree cache'] = _bool(config, 'kdtree cache')
+        self['analytic jacobian'] = _bool(config, 'analytic jacobian')
+        self['profile'] = _bool(config, 'profile')
+        self['result cache size'] = float(_number(config, 'result cache size', _literal(config, 'result cache size')))
+        self['checkpoint'] = _bool(config, 'checkpoint')
+        self['precision'] = _choice(config, 'precision', PRECISIONS)
+        # None to fit every element
+        fitElements = _literal(config, 'fit elements')
+        if not isinstance(fitElements, (list, tuple)):
+            raise FitConfigError('fit elements', config['fit elements'], 'must be a list of element numbers')
+        self['fit elements'] = tuple(sorted(set(
+            _number(config, 'fit elements', e, 0, True) for e in fitElements))) or None
+        if (self['fit elements'] is not None) and not (self['analytic jacobian'] or self['fit mode'] == 'ICP'):
+            raise FitConfigError('fit elements', config['fit elements'],
+                                 'requires the analytic jacobian or the ICP fit mode')
+        self['timeout'] = float(_number(config, 'timeout', _literal(config, 'timeout')))
+        for key in ('decimation voxel size', 'decimation disk radius'):
+            self[key] = _scheduled(config, key, lambda v: float(_number(config, key, v)))
+        self.stages = scheduleArgs(self)
+
+
+_fitConfigCache = cache.LRUCache(maxSize=16)
+
+
+def parseFitConfigs(config):
+    """
+    Return the FitConfig for a step-style config dictionary. FitConfigs
+    are cached by their string values, so configs are parsed once
+    however many fits or batch jobs use them.
+    """
+    key = tuple((k, config[k]) for k in sorted(FIT_CONFIG_DEFAULTS))
+    args = _fitConfigCache.get(key)
+    if args is None:
+        args = FitConfig(config)
+        _fitConfigCache.put(key, args)
+
+    return args
+
+
+def resultConfig(args):
+    """
+    Return the (key, value) pairs of the configs in args that change the
+    result of a cold-started fit that runs to completion, sorted by key
+    and with arrays as lists, for keying cached fit results.
+    """
+    return [(k, v.tolist() if isinstance(v, np.ndarray) else v)
+            for k, v in sorted(args.items()) if k not in RESULT_INDEPENDENT_KEYS]
+
+
+def _isStageList(key, value):
+    if key == 'slave mesh discretisation':
+        return isinstance(value[0], (list, tuple))
+    return isinstance(value, (list, tuple))
+
+
+def scheduleArgs(args):
+    """
+    Split args into the args of each stage of a coarse-to-fine fit.
+    Each of the SCHEDULE_KEYS may be given as a list with one value per
+    stage, e.g. a slave mesh discretisation of [[4,4],[7,7],[10,10]]
+    with max iterations [2,2,5]. Single values are used for every stage.
+    """
+    nStages = None
+    for key in SCHEDULE_KEYS:
+        if _isStageList(key, args[key]):
+            if (nStages is not None) and (len(args[key]) != nStages):
+                raise FitConfigError(key, args[key], 'scheduled configs must have the same number of stages')
+            nStages = len(args[key])
+
+    stages = []
+    for i in range(nStages or 1):
+        stageArgs = dict(args)
+        for key in SCHEDULE_KEYS:
+            if _isStageList(key, args[key]):
+                stageArgs[key] = args[key][i]
+        stages.append(stageArgs)
+
+    return stages
+
+
+def asFloatArray(a):
+    """
+    Return a as a C-contiguous float64 array, copying it only if its
+    dtype or layout has to be converted. Arrays that already are, such
+    as read-only np.memmap or np.load(path, mmap_mode='r') arrays, are
+    used in place, so their closest point searches run directly on the
+    mapped file. a can also be the path of a .npy file, which is then
+    memory-mapped. The returned array must not be modified.
+    """
+    if isinstance(a, str):
+        a = np.load(a, mmap_mode='r')
+    return np.require(a, dtype=float, requirements='C')
+
+
+def makeHostGF(slaveGF, hostElementType, pad=HOST_MESH_PAD, hostCache=cache.hostMeshCache):
+    """
+    Create a host mesh of the given element type around slaveGF. Meshes
+    are taken from hostCache if one has already been made for the same
+    slave parameters. If hostCache is None, the mesh is always rebuilt.
+    """
+    if hostCache is None:
+        print('creating host mesh of type', hostElementType)
+        return GFF.makeHostMesh(slaveGF.get_field_parameters(), pad, hostElementType)
+
+    return hostCache.getHostGF(slaveGF.field_parameters, hostElementType, pad)
+
+
+def dataTermMode(fitMode):
+    """
+    Mode of the objectives.DataObjective of fitMode. ICP fits the EPDP
+    distance.
+    """
+    return 'EPDP' if fitMode == 'ICP' else fitMode
+
+
+def makeDataObj(slaveGF, data, args, dataTree=None, dtype=np.float64, weights=None):
+    """
+    Create the data term of the slave mesh objective function for the
+    configured fit mode, distance search and outlier rejection, with
+    optional weights for each point of data.
+    """
+    return objectives.DataObjective(slaveGF, data, args['slave mesh discretisation'],
+                                    dataTermMode(args['fit mode']), dataTree=dataTree,
+                                    nClosestPoints=args['n closest points'],
+                                    treeArgs=args['kdtree args'], workers=args['query workers'],
+                                    dtype=dtype, trimFraction=args['trim fraction'],
+                                    trimMAD=args['trim MAD'], weights=weights,
+                                    elements=args['fit elements'])
+
+
+def makeSlaveObj(slaveGF, data, args, dataTree=None, weights=None):
+    """
+    Create the slave mesh objective function for the configured fit mode.
+    dataTree is an optional prebuilt KD-tree of data for the EPDP, 2way
+    and ICP modes, and weights are optional weights of the data points.
+    Returns the full objective and its data term.
+
+    The data term is computed in float32 if configured, but only with the
+    analytic jacobian or ICP, as finite differences need float64
+    residuals.
+    """
+    if args['precision'] == 'float32' and (args['analytic jacobian'] or args['fit mode'] == 'ICP'):
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    slaveGObj = makeDataObj(slaveGF, data, args, dataTree, dtype, weights)
+    slaveSobObj = objectives.SobolevPenalty(slaveGF, args['slave sobelov discretisation'],
+                                            args['slave sobelov weight'], args['fit elements'])
+    slaveNormObj = objectives.NormalPenalty(slaveGF, args['slave normal discretisation'],
+                                            args['fit elements'])
+    slaveObj = objectives.SlaveObjective(slaveGObj, slaveSobObj, slaveNormObj,
+                                         args['slave normal weight'])
+
+    return slaveObj, slaveGObj
+
+
+def _float64Operator(J):
+    """
+    J as a float64 LinearOperator. Products of a sparse matrix with a
+    vector of another dtype convert the whole matrix, so vectors are
+    converted to the dtype of J instead.
+    """
+    return LinearOperator(
+        J.shape, dtype=np.float64,
+        matvec=lambda v: J.dot(v.astype(J.dtype).ravel()).astype(np.float64),
+        rmatvec=lambda v: J.T.dot(v.astype(J.dtype).ravel()).astype(np.float64),
+    )
+
+
+def hostEmbedding(hostGF, slaveGF, slaveXi, slaveNodes=None):
+    """
+    The slave parameters as the affine function c + K.h of the host
+    parameters h that are optimised. The slave nodes are embedded in the
+    host mesh at slaveXi, so without slaveNodes c is 0, K is the host
+    basis values at slaveXi for each dimension and every host parameter
+    is optimised.
+
+    If slaveNodes is given, only those slave nodes move, and only the
+    host parameters with support over them are optimised. The other
+    slave nodes keep their current parameters in c, and the other host
+    parameters are fixed at their current values.
+
+    Returns E, K, c and active, where E is the host basis values at
+    slaveXi of each optimised host node, for one dimension, and active
+    are the indices of the optimised parameters in the flattened host
+    parameters.
+    """
+    E = cache.embeddingCache.getMatrix(hostGF, slaveXi)
+    if slaveNodes is None:
+        active = np.arange(hostGF.get_field_parameters().size)
+        return E, sparse.kron(sparse.identity(3), E, format='csr'), 0.0, active
+
+    nSlave, nHost = E.shape
+    fitted = np.zeros(nSlave, dtype=bool)
+    fitted[slaveNodes] = True
+    fittedE = E[slaveNodes]
+    fittedE.eliminate_zeros()
+    hostNodes = np.unique(fittedE.indices)
+    activeE = sparse.diags(fitted.astype(float)).dot(E[:, hostNodes]).tocsr()
+    activeE.eliminate_zeros()
+    active = (np.arange(3)[:, np.newaxis] * nHost + hostNodes).ravel()
+    K = sparse.kron(sparse.identity(3), activeE, format='csr')
+
+    h = hostGF.get_field_parameters().ravel()
+    embedded = sparse.kron(sparse.identity(3), E, format='csr').dot(h)
+    c = np.where(np.tile(fitted, 3), embedded - K.dot(h[active]), slaveGF.get_field_parameters().ravel())
+    return activeE, K, c, active
+
+
+def hostMeshFitSparse(hostGF, slaveGF, slaveObj, slaveXi=None, maxIt=0, sobD=None,
+                      sobW=1e-5, xtol=1e-6, verbose=True, dtype=np.float64, slaveNodes=None):
+    """
+    Host mesh fit as fitting_tools.hostMeshFitMulti, but solved with the
+    analytic Jacobian of slaveObj instead of finite differences.
+
+    The slave parameters are the linear function K.h of the host
+    parameters h, where K holds the host basis values at slaveXi, so the
+    Jacobian of the slave residuals is slaveObj.jacobian(K.h).K. It is
+    stacked with the Jacobian of the host Sobolev penalty and given to
+    the solver as a sparse matrix, so each iteration costs about one
+    objective evaluation regardless of the number of host parameters.
+
+    dtype is the precision of the Jacobian of slaveObj, in which the
+    Jacobian given to the solver is kept, as a LinearOperator if it is
+    not float64. The parameters are always float64.
+
+    If slaveNodes is given, only those slave nodes are fitted, see
+    hostEmbedding.
+
+    maxIt 0 leaves the number of objective evaluations to the solver, as
+    for hostMeshFitMulti.
+
+    Returns hostParamsOpt, slaveParamsOpt, slaveXi, RMSEFitted
+    """
+    sobD = [4, 4, 4] if sobD is None else sobD
+    if slaveXi is None:
+        if verbose:
+            print('calculating slave xi...')
+        slaveXi = cache.embeddingCache.getSlaveXi(hostGF, slaveGF.field_parameters)
+
+    E, K, c, active = hostEmbedding(hostGF, slaveGF, slaveXi, slaveNodes)
+    KJ = K.astype(dtype)
+    smoother = objectives.SobolevPenalty(hostGF, sobD, HOST_SOBOLEV_WEIGHTS * sobW)
+    h = hostGF.get_field_parameters().ravel().copy()
+
+    def hostMeshObj(hActive):
+        h[active] = hActive
+        hostGF.set_field_parameters(h.reshape((3, -1, 1)))
+        return np.hstack([slaveObj(c + K.dot(hActive)), smoother(h)])
+
+    def hostMeshJac(hActive):
+        h[active] = hActive
+        slaveJ = slaveObj.jacobian(c + K.dot(hActive)).dot(KJ)
+        J = sparse.vstack([slaveJ, smoother.jacobian(h).tocsc()[:, active]], format='csr', dtype=dtype)
+        if J.dtype == np.float64:
+            return J
+        return _float64Operator(J)
+
+    result = least_squares(hostMeshObj, h[active], jac=hostMeshJac, method='trf',
+                           tr_solver='lsmr', xtol=xtol, max_nfev=(maxIt * SPARSE_EVALS_PER_ITERATION) or None,
+                           verbose=2 if verbose else 0)
+
+    h[active] = result.x
+    hostParamsOpt = h.reshape((3, -1, 1))
+    slaveParamsOpt = (c + K.dot(result.x)).reshape((3, -1, 1))
+    hostGF.set_field_parameters(hostParamsOpt)
+    slaveGF.set_field_parameters(slaveParamsOpt)
+
+    RMSEFitted = np.sqrt(slaveObj(slaveParamsOpt.ravel()).mean())
+    if verbose:
+        print('final slave rms: {}'.format(RMSEFitted))
+
+    return hostParamsOpt, slaveParamsOpt, slaveXi, RMSEFitted
+
+
+def _icpCost(ep, q, w, penalties):
+    """
+    The objective minimised by hostMeshFitICP: the squared distances
+    between the slave mesh points ep and their closest data points q,
+    weighted by w if not None, and the squared penalty residuals.
+    """
+    e = ((ep - q) ** 2).sum(1)
+    if w is not None:
+        e *= w
+    return e.sum() + sum(np.dot(r, r) for r in penalties)
+
+
+def hostMeshFitICP(hostGF, slaveGF, slaveObj, slaveXi=None, maxIt=0, sobD=None,
+                   sobW=1e-5, xtol=1e-6, verbose=True, profile=None, slaveNodes=None):
+    """
+    Host mesh fit by alternating, ICP-style, between finding the closest
+    data point to each slave mesh point and solving for the host
+    parameters with those correspondences fixed.
+
+    slaveObj is an ObjectiveMonitor of an objectives.SlaveObjective with
+    an EPDP data term, with evalsPerIteration None. With fixed
+    correspondences q, the slave mesh points are the linear function M.h
+    of the host parameters h, so the data term |M.h - q|^2 is quadratic.
+    The slave and host penalties are linearised about the current
+    parameters, and each outer iteration solves the normal equations of
+    the resulting linear least squares problem, whose data block M^T.M
+    is the same for every iteration unless data weights or outlier
+    rejection weight its rows.
+
+    The linearised penalties and the change of correspondences can make
+    a full step overshoot, so steps are Levenberg-Marquardt damped: a
+    step is only accepted if it reduces the squared distances to the
+    closest data points plus the squared penalties, and otherwise the
+    damping is increased and the step solved again. The fit runs maxIt
+    outer iterations, ICP_MAX_ITERATIONS if maxIt is 0, and stops early
+    once the accepted step is smaller than xtol relative to the
+    parameters or no step reduces the objective, so the parameters
+    returned are the best reached.
+
+    The time of each outer iteration and of its correspondence search
+    and linear solves are printed if verbose, and are recorded in
+    profile, a profiling.FitProfile, if given.
+
+    If slaveNodes is given, only those slave nodes are fitted, see
+    hostEmbedding.
+
+    Returns hostParamsOpt, slaveParamsOpt, slaveXi, RMSEFitted
+    """
+    sobD = [4, 4, 4] if sobD is None else sobD
+    if slaveXi is None:
+        if verbose:
+            print('calculating slave xi...')
+        slaveXi = cache.embeddingCache.getSlaveXi(hostGF, slaveGF.field_parameters)
+
+    slaveObjective = slaveObj.slaveObj
+    dataObj = slaveObjective.dataObj
+    E, K, c, active = hostEmbedding(hostGF, slaveGF, slaveXi, slaveNodes)
+    M = dataObj.A.astype(float).dot(E).tocsr()
+    MTM = sparse.kron(sparse.identity(3), M.T.dot(M)).toarray()
+    # the penalty Jacobians are nearly dense in the host parameters, so
+    # are multiplied out as dense arrays
+    denseE = E.toarray()
+    nSlave = E.shape[0]
+    smoother = objectives.SobolevPenalty(hostGF, sobD, HOST_SOBOLEV_WEIGHTS * sobW)
+
+    def trialCost(hTrial):
+        s = c + K.dot(hTrial[active])
+        slaveObj(s)
+        terms = slaveObjective.terms()
+        return _icpCost(*dataObj.correspondences(s),
+                        penalties=(terms['sobolev'], terms['normal'], smoother(hTrial)))
+
+    h = hostGF.get_field_parameters().ravel().copy()
+    damping = 0.0
+    for iteration in range(maxIt or ICP_MAX_ITERATIONS):
+        t0 = time.perf_counter()
+        s = c + K.dot(h[active])
+        dataObj.updateInliers(s)
+        ep, q, w = dataObj.correspondences(s)
+        dataM, dataMTM = M, MTM
+        if w is not None:
+            # W.M, so that dataM^T.x is M^T.W.x
+            dataM = M.multiply(w[:, np.newaxis]).tocsr()
+            dataMTM = sparse.kron(sparse.identity(3), M.T.dot(dataM)).toarray()
+        t1 = time.perf_counter()
+
+        # normal equations of |M.(h + dh) - q|^2 + |r + J.dh|^2 where r
+        # and J are the penalty residuals and Jacobian
+        slaveR, slaveJ = slaveObjective.penalties(s)
+        slaveJ = slaveJ.tocsc()
+        slaveJ = np.hstack([slaveJ[:, d * nSlave:(d + 1) * nSlave].dot(denseE) for d in range(3)])
+        hostR = smoother(h)
+        hostJ = smoother.jacobian(h).tocsc()[:, active].toarray()
+        N = dataMTM + slaveJ.T.dot(slaveJ) + hostJ.T.dot(hostJ)
+        b = dataM.T.dot(q - ep).T.ravel() - slaveJ.T.dot(slaveR) - hostJ.T.dot(hostR)
+        cost = _icpCost(ep, q, w, (slaveR, hostR))
+        D = np.diag(np.diag(N))
+
+        tSolve = 0.0
+        for trial in range(ICP_MAX_STEP_TRIALS):
+            t = time.perf_counter()
+            dh = np.linalg.lstsq(N + damping * D, b, rcond=ICP_RCOND)[0]
+            hTrial = h.copy()
+            hTrial[active] += dh
+            tSolve += time.perf_counter() - t
+            trialCostValue = trialCost(hTrial)
+            if trialCostValue < cost:
+                break
+            damping = ICP_DAMPING if damping == 0.0 else damping * ICP_DAMPING_FACTOR
+        else:
+            if verbose:
+                print('ICP iteration {}: no step reduced the objective, stopping'.format(iteration + 1))
+            break
+
+        damping = damping / ICP_DAMPING_FACTOR if damping > ICP_DAMPING else 0.0
+        h = hTrial
+        hostGF.set_field_parameters(h.reshape((3, -1, 1)))
+        slaveObj.iterationDone(c + K.dot(h[active]))
+        t3 = time.perf_counter()
+        if profile is not None:
+            profile.record('correspondence', t1 - t0)
+            profile.record('linear solve', tSolve)
+            profile.record('outer iteration', t3 - t0)
+        if verbose:
+            print('ICP iteration {}: rms {:.6f}, {} step(s), {:.3f} s (correspondence {:.3f} s, solve {:.3f} s)'.format(
+                iteration + 1, slaveObj.bestRMSE, trial + 1, t3 - t0, t1 - t0, tSolve))
+        if np.linalg.norm(dh) <= xtol * np.linalg.norm(h[active]):
+            break
+
+    hostParamsOpt = h.reshape((3, -1, 1))
+    slaveParamsOpt = (c + K.dot(h[active])).reshape((3, -1, 1))
+    hostGF.set_field_parameters(hostParamsOpt)
+    slaveGF.set_field_parameters(slaveParamsOpt)
+
+    # not through slaveObj, so that it is not counted as an iteration
+    RMSEFitted = np.sqrt(slaveObjective(slaveParamsOpt.ravel()).mean())
+    if verbose:
+        print('final slave rms: {}'.format(RMSEFitted))
+
+    return hostParamsOpt, slaveParamsOpt, slaveXi, RMSEFitted
+
+
+def hostMeshFit(data, slaveGF, hostGF, args, slaveXi=None, dataTree=None, timeout=None,
+                callback=None, cancelToken=None, errorData=None, profile=None, checkpoint=None,
+                dataWeights=None, errorWeights=None):
+    """
+    Host mesh fit slaveGF to data using hostGF as the host mesh. slaveGF
+    and hostGF are left set to their fitted parameters.
+
+    The fit starts from the current parameters of hostGF. If slaveXi, the
+    host element coordinates of the slave nodes, is given, it is used
+    instead of searching for the slave nodes in the host mesh. dataTree
+    is an optional prebuilt KD-tree of data, see makeSlaveObj.
+
+    If cancelToken is cancelled during the fit, or the fit runs for
+    longer than timeout (seconds), the solver is stopped and the best
+    parameters found so far are returned. If callback is given, it is
+    called with the progress of the fit as described in ObjectiveMonitor.
+
+    fitErrors and RMSEFitted are calculated for the points errorData if
+    given, e.g. the full point cloud when data has been decimated.
+
+    With outlier rejection configured, the outliers are found at the
+    start of each outer iteration of the ICP mode, and at the start
+    parameters for the other modes, whose solvers need the objective to
+    stay the same through the fit. They are found again at the fitted
+    parameters for fitErrors and RMSEFitted.
+
+    dataWeights, if given, weight the data term of each point of data,
+    see objectives.DataObjective. Points of zero weight are left out of
+    the fit, but their errors are still calculated. fitErrors are
+    unweighted distances and RMSEFitted is their RMS weighted by
+    dataWeights, or by errorWeights for errorData.
+
+    If args['fit elements'] lists slave mesh elements, only they are
+    fitted: the objective is only evaluated on them, slave nodes of
+    other elements are fixed and only the host parameters with support
+    over the fitted nodes are optimised, see hostEmbedding. fitErrors
+    and RMSEFitted are then those of the fitted elements.
+
+    If profile, a profiling.FitProfile, is given, the time of each term
+    of the slave objective, of the solver between objective evaluations
+    and of the whole fit, as 'stage', are recorded in it.
+
+    If checkpoint, a checkpoint.FitCheckpoint, is given, it is updated
+    with the current parameters of the solver after the number of
+    objective evaluations it is allowed for each max iteration, and only
+    the max iterations not already in the checkpoint are run. A resumed
+    solver restarts its step size control, so a resumed fit can differ
+    slightly from an uninterrupted one.
+
+    Returns hostParamsOpt, slaveParamsOpt, slaveXi, RMSEFitted, fitErrors
+    """
+    if profile is not None:
+        stopProfile = profile.timer('stage')
+    if cancelToken is None:
+        cancelToken = CancelToken()
+    if timeout is not None:
+        cancelToken.setTimeout(timeout)
+    if dataWeights is not None:
+        fitData, fitWeights = decimation.dropZeroWeights(data, dataWeights)
+        if fitData is not data:
+            if errorData is None:
+                errorData, errorWeights = data, dataWeights
+            data, dataWeights, dataTree = fitData, fitWeights, None
+
+    maxIt = args['max iterations']
+    iterationCallback = None
+    if checkpoint is not None:
+        if maxIt > 0:
+            # max iterations 0, the solver default, has no count to resume
+            maxIt = max(maxIt - checkpoint.iteration, 0)
+        iteration0 = checkpoint.iteration
+
+        def iterationCallback(iteration, slaveParams, hostParams, RMSE):
+            checkpoint.update(iteration0 + iteration, hostParams, slaveParams, slaveXi, RMSE)
+            if args['verbose']:
+                print('checkpoint after iteration {}: rms {}'.format(iteration0 + iteration, RMSE))
+
+    if args['fit mode'] == 'ICP':
+        # hostMeshFitICP reports its accepted iterations
+        evalsPerIteration = None
+    elif args['analytic jacobian']:
+        evalsPerIteration = SPARSE_EVALS_PER_ITERATION
+    else:
+        # hostMeshFitMulti allows one evaluation per host parameter per iteration
+        evalsPerIteration = hostGF.get_field_parameters().size
+
+    slaveNodes = None
+    if args['fit elements'] is not None:
+        try:
+            slaveNodes = basis.elementsNodes(slaveGF, args['fit elements'])
+        except ValueError as e:
+            raise FitConfigError('fit elements', list(args['fit elements']), str(e))
+
+    slaveObj, slaveGObj = makeSlaveObj(slaveGF, data, args, dataTree, dataWeights)
+    slaveObj.profile = profile
+    slaveObj = ObjectiveMonitor(slaveObj, hostGF, callback=callback, cancelToken=cancelToken,
+                                profile=profile, iterationCallback=iterationCallback,
+                                evalsPerIteration=evalsPerIteration)
+    if slaveXi is None:
+        # found here rather than by the solver so that it is kept if the
+        # fit is cancelled
+        slaveXi = cache.embeddingCache.getSlaveXi(hostGF, slaveGF.field_parameters)
+
+    # run HMF
+    try:
+        # e.g. cancelled during the slave xi search
+        cancelToken.check()
+        if (checkpoint is not None) and (checkpoint.iteration > 0) and (args['max iterations'] > 0) \
+                and (maxIt == 0):
+            # resumed after the last iteration of this stage
+            hostParamsOpt = hostGF.get_field_parameters()
+            slaveParamsOpt = slaveGF.get_field_parameters()
+        elif args['fit mode'] == 'ICP':
+            hostParamsOpt, slaveParamsOpt, \
+            slaveXi, RMSEFitted = hostMeshFitICP(
+                hostGF, slaveGF, slaveObj,
+                slaveXi=slaveXi,
+                maxIt=maxIt,
+                sobD=args['host sobelov discretisation'],
+                sobW=args['host sobelov weight'],
+                verbose=args['verbose'],
+                xtol=1e-6,
+                profile=profile,
+                slaveNodes=slaveNodes,
+            )
+        elif args['analytic jacobian']:
+            hostParamsOpt, slaveParamsOpt, \
+            slaveXi, RMSEFitted = hostMeshFitSparse(
+                hostGF, slaveGF, slaveObj,
+                slaveXi=slaveXi,
+                maxIt=maxIt,
+                sobD=args['host sobelov discretisation'],
+                sobW=args['host sobelov weight'],
+                verbose=args['verbose'],
+                xtol=1e-6,
+                dtype=slaveGObj.dtype,
+                slaveNodes=slaveNodes,
+            )
+        else:
+            hostParamsOpt, slaveParamsOpt, \
+            slaveXi, RMSEFitted = fitting_tools.hostMeshFitMulti(
+                hostGF, slaveGF, slaveObj,
+                slave_xi=slaveXi,
+                max_it=maxIt,
+                sob_d=args['host sobelov discretisation'],
+                sob_w=args['host sobelov weight'],
+                verbose=args['verbose'],
+                xtol=1e-6,
+            )
+    except FitCancelledError as e:
+        print('{}, returning best fit after {} evaluations'.format(e, slaveObj.nEvals))
+        if slaveObj.bestSlaveParams is None:
+            hostParamsOpt = hostGF.get_field_parameters()
+            slaveParamsOpt = slaveGF.get_field_parameters()
+        else:
+            hostParamsOpt = slaveObj.bestHostParams
+            slaveParamsOpt = slaveObj.bestSlaveParams
+
+    slaveGF.set_field_parameters(slaveParamsOpt)
+    hostGF.set_field_parameters(hostParamsOpt)
+
+    if errorData is not None:
+        slaveGObj = makeDataObj(slaveGF, errorData, args, weights=errorWeights)
+    else:
+        slaveGObj.updateInliers(slaveParamsOpt)
+    fitErrors = np.sqrt(slaveGObj(slaveParamsOpt, weighted=False))
+    if slaveGObj.inliers is not None:
+        # rejected outliers have no error
+        fitErrors[~slaveGObj.inliers] = np.nan
+    if slaveGObj.residualWeights is None:
+        RMSEFitted = np.sqrt(np.nanmean(fitErrors ** 2.0))
+    else:
+        fitted = np.isfinite(fitErrors)
+        w = slaveGObj.residualWeights[fitted]
+        RMSEFitted = np.sqrt((w * fitErrors[fitted] ** 2.0).sum() / w.sum())
+    if profile is not None:
+        stopProfile(fitErrors)
+
+    return hostParamsOpt, slaveParamsOpt, slaveXi, RMSEFitted, fitErrors
+
+
+def hostMeshFitStages(stages, slaveGF, hostGF, slaveXi=None, timeout=None, callback=None,
+                      cancelToken=None, errorData=None, profile=None, checkpoint=None,
+                      errorWeights=None):
+    """
+    Host mesh fit through a list of (data, args, dataTree, dataWeights)
+    stages, e.g. from scheduleArgs with data decimated for each stage.
+    dataTree and dataWeights may be None. Each stage starts from the
+    host mesh fitted by the previous stage, so most of the deformation
+    is fitted in the cheaper coarse stages. Arguments are as for
+    hostMeshFit, with timeout, cancelToken, profile and checkpoint
+    covering all stages.
+
+    If checkpoint has been loaded from a saved checkpoint, the fit
+    resumes from it: slaveGF, hostGF and slaveXi are set from it and the
+    fit continues from its stage and iteration.
+
+    Returns hostParamsOpt, slaveParamsOpt, slaveXi, RMSEFitted, fitErrors
+    of the last stage run.
+    """
+    if cancelToken is None:
+        cancelToken = CancelToken()
+    if timeout is not None:
+        cancelToken.setTimeout(timeout)
+
+    start = 0
+    if (checkpoint is not None) and (checkpoint.hostParams is not None):
+        if stages[checkpoint.stage][1]['verbose']:
+            print('resuming fit from stage {} iteration {}'.format(checkpoint.stage + 1, checkpoint.iteration))
+        hostGF.set_field_parameters(checkpoint.hostParams)
+        slaveGF.set_field_parameters(checkpoint.slaveParams)
+        slaveXi = checkpoint.slaveXi
+        start = checkpoint.stage
+
+    for i in range(start, len(stages)):
+        data, args, dataTree, dataWeights = stages[i]
+        if checkpoint is not None:
+            checkpoint.startStage(i)
+        if (len(stages) > 1) and args['verbose']:
+            print('fit stage {} of {}: slave mesh discretisation {}, {} points'.format(
+                i + 1, len(stages), args['slave mesh discretisation'], len(data)))
+        output = hostMeshFit(data, slaveGF, hostGF, args, slaveXi=slaveXi, dataTree=dataTree,
+                             callback=callback, cancelToken=cancelToken, errorData=errorData,
+                             profile=profile, checkpoint=checkpoint, dataWeights=dataWeights,
+                             errorWeights=errorWeights)
+        slaveXi = output[2]
+        if cancelToken.isCancelled():
+            break
+
+    return output
@@ -18,34 +18,65 @@ This file is part of MAP Client. (http://launchpad.net/mapclient)
     along with MAP Client.  If not, see <http://www.gnu.org/licenses/>..
 '''
 import os
+import traceback
 
 os.environ['ETS_TOOLKIT'] = 'qt'
 
-from PySide6.QtWidgets import QDialog, QAbstractItemView, QTableWidgetItem
+from PySide6.QtWidgets import QDialog, QAbstractItemView, QTableWidgetItem, QMessageBox
 from PySide6.QtCore import Qt
-from PySide6.QtCore import QThread, Signal
+from PySide6.QtCore import QThread, QTimer, Signal
 
 from mapclientplugins.fieldworkhostmeshfittingstep.ui_mayavihostmeshfittingviewerwidget import Ui_Dialog
+from mapclientplugins.fieldworkhostmeshfittingstep import cache
+from mapclientplugins.fieldworkhostmeshfittingstep import fitting
+from mapclientplugins.fieldworkhostmeshfittingstep import profiling
 from traits.api import HasTraits, Instance, on_trait_change, \
     Int, Dict
 
 from gias3.mapclientpluginutilities.viewers import MayaviViewerObjectsContainer, MayaviViewerFieldworkModel, colours
 from gias3.mapclientpluginutilities.viewers.mayaviviewerdatapoints import MayaviViewerDataPoints
-
-import copy
+import numpy as np
 
 
 class _ExecThread(QThread):
     update = Signal(tuple)
+    progress = Signal(tuple)
+    failed = Signal(str)
 
     def __init__(self, func):
         QThread.__init__(self)
         self.func = func
+        self.cancelToken = fitting.CancelToken()
+
+    def start(self):
+        self.cancelToken = fitting.CancelToken()
+        QThread.start(self)
+
+    def cancel(self):
+        """
+        Stop a running fit at its next objective evaluation or between
+        its setup phases. Does not wait for the fit to stop, which then
+        emits update or failed.
+        """
+        self.cancelToken.cancel()
 
     def run(self):
-        output = self.func()
+        try:
+            output = self.func(callback=self._progress, cancelToken=self.cancelToken)
+        except (fitting.FitConfigError, fitting.FitCancelledError) as e:
+            self.failed.emit(str(e))
+            return
+        except Exception as e:
+            # e.g. invalid data weights, which would otherwise end the
+            # thread without unlocking the UI
+            traceback.print_exc()
+            self.failed.emit('{}: {}'.format(type(e).__name__, e))
+            return
         self.update.emit(output)
 
+    def _progress(self, *output):
+        self.progress.emit(output)
+
 
 class MayaviHostMeshFittingViewerWidget(QDialog):
     '''
@@ -60,12 +91,17 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
     _hostGFUnfittedRenderArgs = {'color': (1, 0, 0)}
     _hostGFFittedRenderArgs = {'color': (1, 1, 0)}
     _GFD = [15, 15]
+    _maxRedrawRate = 5.0  # max redraws per second of the fitted mesh during a fit
 
     _fitParamTableRows = ('fit mode', 'host element type', 'slave mesh discretisation', \
                           'slave sobelov discretisation', 'slave sobelov weight', \
                           'slave normal discretisation', 'slave normal weight', \
                           'host sobelov discretisation', 'host sobelov weight', 'max iterations', \
-                          'n closest points', 'kdtree args', 'verbose')
+                          'n closest points', 'kdtree args', 'query workers', 'trim fraction', 'trim MAD', \
+                          'verbose', 'warm start', \
+                          'analytic jacobian', 'timeout', \
+                          'decimation voxel size', 'decimation disk radius', 'profile', \
+                          'precision', 'fit elements')
 
     _renderHost = False
 
@@ -83,15 +119,28 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
         self.selectedObjectName = None
         self._data = data
         self._slaveGFUnfitted = slaveGFUnfitted
-        self._slaveGFFitted = copy.deepcopy(self._slaveGFUnfitted)
+        self._slaveGFFitted = cache.copyGF(self._slaveGFUnfitted)
         self._hostGFUnfitted = hostGFUnfitted
-        self._hostGFFitted = copy.deepcopy(self._hostGFUnfitted)
+        self._hostGFFitted = cache.copyGF(self._hostGFUnfitted)
         self._fitFunc = fitFunc
         self._config = config
         self._resetCallback = resetCallback
 
         self._worker = _ExecThread(self._fitFunc)
         self._worker.update.connect(self._fitUpdate)
+        self._worker.progress.connect(self._fitCallback)
+        self._worker.failed.connect(self._fitFailed)
+
+        # progress redraws are limited to _maxRedrawRate and always show
+        # the latest progress received
+        self._fitProgress = None
+        self._fitCancelled = False
+        # reset or abort requested during a fit, run once the fit stops
+        self._afterCancel = None
+        self._redrawTimer = QTimer(self)
+        self._redrawTimer.setSingleShot(True)
+        self._redrawTimer.setInterval(int(1000.0 / self._maxRedrawRate))
+        self._redrawTimer.timeout.connect(self._drawFitProgress)
 
         # create self._objects
         self._objects = MayaviViewerObjectsContainer()
@@ -126,8 +175,8 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
         self._ui.screenshotSaveButton.clicked.connect(self._saveScreenShot)
 
         # self._ui.fitButton.clicked.connect(self._fit)
-        self._ui.fitButton.clicked.connect(self._worker.start)
         self._ui.fitButton.clicked.connect(self._fitLockUI)
+        self._ui.fitButton.clicked.connect(self._fit)
 
         self._ui.resetButton.clicked.connect(self._reset)
         self._ui.abortButton.clicked.connect(self._abort)
@@ -140,10 +189,34 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
         # set values for the params table
         for row, param in enumerate(self._fitParamTableRows):
             self._ui.fitParamsTableWidget.setItem(row, 0, QTableWidgetItem(self._config[param]))
+        self._validateFitParams()
 
     def _fitParamsTableChanged(self, item):
         param = self._fitParamTableRows[item.row()]
         self._config[param] = item.text()
+        self._validateFitParams()
+
+    def _validateFitParams(self):
+        """
+        Mark the first invalid fit param with its error and only allow
+        fitting if every param is valid.
+        """
+        error = None
+        try:
+            fitting.FitConfig(self._config)
+        except fitting.FitConfigError as e:
+            error = e
+
+        table = self._ui.fitParamsTableWidget
+        # setting tooltips would otherwise signal another change
+        table.blockSignals(True)
+        for row, param in enumerate(self._fitParamTableRows):
+            item = table.item(row, 0)
+            if item is not None:
+                item.setToolTip(str(error) if (error is not None) and (error.key == param) else '')
+        table.blockSignals(False)
+        self._ui.fitButton.setEnabled(error is None)
+        return error is None
 
     def _initialiseObjectTable(self):
 
@@ -222,14 +295,60 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
         for name in self._objects.getObjectNames():
             self._objects.getObject(name).draw(self._scene)
 
+    def _fit(self):
+        self._fitCancelled = False
+        self._worker.start()
+
+    def _cancelFit(self, afterCancel):
+        """
+        Stop a running fit and discard its output, then call afterCancel
+        once the fit has stopped, without blocking the GUI meanwhile.
+        Returns True if a fit was running.
+        """
+        if not self._worker.isRunning():
+            return False
+        self._fitCancelled = True
+        self._afterCancel = afterCancel
+        self._worker.cancel()
+        return True
+
+    def _fitCancelledFinished(self):
+        self._fitUnlockUI()
+        afterCancel, self._afterCancel = self._afterCancel, None
+        if afterCancel is not None:
+            afterCancel()
+
+    def _fitFailed(self, message):
+        self._redrawTimer.stop()
+        self._fitProgress = None
+        if self._fitCancelled:
+            self._fitCancelledFinished()
+            return
+        self._fitUnlockUI()
+        self._validateFitParams()
+        QMessageBox.warning(self, 'Fit Failed', message)
+
     def _fitUpdate(self, fitOutput):
+        self._redrawTimer.stop()
+        self._fitProgress = None
+        if self._fitCancelled:
+            # stopped by reset or abort
+            self._fitCancelledFinished()
+            return
+
         slaveGFFitted, slaveGFParamsFitted, \
-        RMSEFitted, errorsFitted, hostGFFitted = fitOutput
+        RMSEFitted, errorsFitted, hostGFFitted, fitProfile = fitOutput
 
-        # update error fields
+        # update error fields, without the rejected outliers, whose errors are NaN
         self._ui.RMSELineEdit.setText(str(RMSEFitted))
-        self._ui.meanErrorLineEdit.setText(str(errorsFitted.mean()))
-        self._ui.SDLineEdit.setText(str(errorsFitted.std()))
+        self._ui.meanErrorLineEdit.setText(str(np.nanmean(errorsFitted)))
+        self._ui.SDLineEdit.setText(str(np.nanstd(errorsFitted)))
+
+        # update profile
+        if fitProfile is None:
+            self._ui.profilePlainTextEdit.setPlainText('Set profile to True to profile the fit.')
+        else:
+            self._ui.profilePlainTextEdit.setPlainText(profiling.formatReport(fitProfile))
 
         # update fitted GF
         slaveFittedObj = self._objects.getObject('slave GF Fitted')
@@ -249,9 +368,7 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
     def _fitLockUI(self):
         self._ui.fitParamsTableWidget.setEnabled(False)
         self._ui.fitButton.setEnabled(False)
-        self._ui.resetButton.setEnabled(False)
         self._ui.acceptButton.setEnabled(False)
-        self._ui.abortButton.setEnabled(False)
 
     def _fitUnlockUI(self):
         self._ui.fitParamsTableWidget.setEnabled(True)
@@ -262,8 +379,22 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
 
     def _fitCallback(self, output):
         """
-        not fully implemented
+        Receive the progress of a running fit. Redraws are deferred to
+        _drawFitProgress so that they happen at most _maxRedrawRate times
+        per second.
         """
+        self._fitProgress = output
+        if not self._redrawTimer.isActive():
+            self._redrawTimer.start()
+
+    def _drawFitProgress(self):
+        if self._fitProgress is None:
+            return
+
+        output = self._fitProgress
+        self._fitProgress = None
+        self._ui.RMSELineEdit.setText(str(output[3]))
+
         slaveGFParamsFitted = output[1]
         slaveFittedObj = self._objects.getObject('slave GF Fitted')
         slaveFittedObj.updateGeometry(slaveGFParamsFitted, self._scene)
@@ -278,6 +409,10 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
             hostFittedTableItem.setCheckState(Qt.Checked)
 
     def _reset(self):
+        if self._cancelFit(self._reset):
+            return
+        self._redrawTimer.stop()
+        self._fitProgress = None
         self._resetCallback()
         slaveFittedObj = self._objects.getObject('slave GF Fitted')
         slaveFittedObj.updateGeometry(self._slaveGFUnfitted.field_parameters.copy(), self._scene)
@@ -299,6 +434,8 @@ class MayaviHostMeshFittingViewerWidget(QDialog):
         self._close()
 
     def _abort(self):
+        if self._cancelFit(self._abort):
+            return
         self._reset()
         self._close()
 
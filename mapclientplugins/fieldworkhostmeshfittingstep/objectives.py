@@ -0,0 +1,447 @@
+'''
+Slave mesh objective functions for host mesh fitting.
+
+These compute the same residuals as geometric_field_fitter.makeObjDPEP,
+makeObjEPDP, makeObj2Way, makeSobelovPenalty2D and normalSmoother2, but
+are built on explicit sparse basis matrices so that each term can also
+return its Jacobian with respect to the slave mesh parameters. The
+parameter vector x is ordered as the flattened (3, number of nodes)
+field parameters, i.e. all x coordinates, then y, then z. The basis
+matrices are cached per slave mesh topology in cache.basisMatrixCache.
+
+Each term can be restricted to a list of slave mesh elements, so that
+only a region of the mesh is fitted. Its residuals are then only
+evaluated on those elements, but the Jacobian still has a column for
+every slave mesh parameter.
+'''
+import time
+
+from scipy import sparse
+from scipy.spatial import cKDTree
+from gias3.fieldwork.field import geometric_field_fitter as GFF
+import numpy as np
+
+from mapclientplugins.fieldworkhostmeshfittingstep import basis
+from mapclientplugins.fieldworkhostmeshfittingstep import cache
+
+# data points per closest point query when the distances are not float64,
+# so that only one chunk at a time of the distances cKDTree returns is
+# float64
+QUERY_CHUNK_SIZE = 65536
+
+
+def _dimBlocks(rowScales, matrices):
+    """
+    Jacobian [J_x, J_y, J_z] where J_d is the sum over matrices M_k of
+    diag(rowScales[k][:, d]).M_k.
+    """
+    blocks = []
+    for d in range(3):
+        J = None
+        for s, M in zip(rowScales, matrices):
+            Jk = M.multiply(s[:, d][:, np.newaxis])
+            J = Jk if J is None else J + Jk
+        blocks.append(J)
+    return sparse.hstack(blocks, format='csr')
+
+
+class DataObjective(object):
+    '''
+    Squared closest point distances between the data and points sampled
+    on the slave mesh at the xi discretisation evalD. mode is one of
+
+        DPEP: from each data point to its closest slave mesh points,
+        EPDP: from each slave mesh point to its closest data points,
+        2way: EPDP followed by DPEP.
+
+    With nClosestPoints > 1 the distance is the mean distance to the
+    closest points. dataTree is an optional prebuilt KD-tree of data.
+
+    Like the other terms, calling the objective with an out array of
+    length nResiduals writes the residuals into out instead of a new
+    array.
+
+    If weights, one per data point, are given, the squared distances
+    of DPEP are multiplied by the square root of the weight of their
+    data point and those of EPDP by that of the mean weight of their
+    closest data points, so that each squared residual is weighted.
+    residualWeights are the weights of the residuals at the last
+    parameters evaluated, or None without weights. Calling with
+    weighted=False gives the unweighted squared distances.
+
+    dtype is the precision of the slave mesh points, the distances and
+    the Jacobian. The data are held once, as a C-contiguous float64
+    array like those of the KD-trees, and are not copied if they already
+    are one, so a KD-tree of data shares them.
+
+    Closest point queries are run on workers threads, -1 for every core,
+    unless treeArgs gives workers.
+
+    Outlying distances of each of the EPDP and DPEP terms can be
+    rejected: the largest trimFraction of them, and those more than
+    trimMAD times their median absolute deviation above their median.
+    The outliers are found at the first parameters evaluated, or at
+    those given to updateInliers, and the same points are rejected at
+    every parameters evaluated until the next update, so that the
+    objective does not jump between e.g. the finite difference probes of
+    one Jacobian. Rejected points have zero residuals and Jacobian rows,
+    and inliers is the mask of the points kept, or None if no rejection
+    is configured.
+
+    If elements is given, the slave mesh is only sampled on those
+    elements.
+    '''
+
+    def __init__(self, slaveGF, data, evalD, mode, dataTree=None, nClosestPoints=1, treeArgs=None,
+                 workers=1, dtype=np.float64, trimFraction=0.0, trimMAD=0.0, weights=None,
+                 elements=None):
+        if mode not in ('DPEP', 'EPDP', '2way'):
+            raise ValueError('unknown fit mode ' + str(mode))
+
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.data = np.ascontiguousarray(data, dtype=float)
+        if mode in ('EPDP', '2way') and dataTree is None:
+            dataTree = cKDTree(self.data)
+        self.A = cache.basisMatrixCache.getMatrices(
+            slaveGF, 'evaluation', evalD, basis.evaluationMatrix, elements).astype(self.dtype, copy=False)
+        self.nClosestPoints = nClosestPoints
+        self.treeArgs = {'workers': workers}
+        if treeArgs is not None:
+            self.treeArgs.update(treeArgs)
+        self.dataTree = dataTree
+        self.trimFraction = trimFraction
+        self.trimMAD = trimMAD
+        self.inliers = None
+        self._inlierMasks = None
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        self.residualWeights = None
+        self.nResiduals = 0
+        if mode in ('EPDP', '2way'):
+            self.nResiduals += self.A.shape[0]
+        if mode in ('DPEP', '2way'):
+            self.nResiduals += len(self.data)
+
+        self._x = None
+        self._terms = None
+
+    def _search(self, x):
+        """
+        Closest point search at parameters x. Results are kept for the
+        Jacobian at the same parameters.
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        if (self._x is not None) and np.array_equal(x, self._x):
+            return self._terms
+
+        ep = self.A.dot(x.reshape((3, -1)).T.astype(self.dtype))
+        k = self.nClosestPoints
+        terms = []
+        if self.mode in ('EPDP', '2way'):
+            d, i = self.dataTree.query(ep, k=k, **self.treeArgs)
+            d = d.reshape((len(ep), k)).astype(self.dtype, copy=False)
+            i = i.reshape((len(ep), k))
+            w = None
+            if self.weights is not None:
+                w = self.weights[np.minimum(i, len(self.data) - 1)].mean(1)
+            terms.append(('EPDP', ep, d, i, None, w))
+        if self.mode in ('DPEP', '2way'):
+            d, i = self._queryData(cKDTree(ep), k)
+            terms.append(('DPEP', ep, d, i, None, self.weights))
+
+        if self.weights is not None:
+            self.residualWeights = np.hstack([t[5] for t in terms])
+        self._x = x.copy()
+        self._terms = terms
+        if self.trimFraction or self.trimMAD:
+            if self._inlierMasks is None:
+                self._inlierMasks = [self._inlierMask(t[2]) for t in terms]
+            self._setInliers()
+        return self._terms
+
+    def updateInliers(self, x):
+        """
+        Find the outliers to reject from the distances at parameters x,
+        e.g. once per outer iteration of a fit. Does nothing if no
+        rejection is configured.
+        """
+        if not (self.trimFraction or self.trimMAD):
+            return
+        self._inlierMasks = [self._inlierMask(t[2]) for t in self._search(x)]
+        self._setInliers()
+
+    def _setInliers(self):
+        """
+        Apply the current inlier masks to the search results.
+        """
+        self._terms = [t[:4] + (mask,) + t[5:] for t, mask in zip(self._terms, self._inlierMasks)]
+        self.inliers = np.hstack(self._inlierMasks)
+
+    def _inlierMask(self, d):
+        """
+        Mask of the points whose mean distance in d is not rejected.
+        """
+        m = d.mean(1)
+        inliers = np.ones(len(m), dtype=bool)
+        nKeep = len(m) - int(self.trimFraction * len(m))
+        if nKeep < len(m):
+            # partition rather than sort for the largest distance kept
+            inliers &= m <= np.partition(m, nKeep - 1)[nKeep - 1]
+        if self.trimMAD:
+            median = np.median(m)
+            mad = np.median(np.abs(m - median))
+            if mad > 0.0:
+                inliers &= m - median <= self.trimMAD * mad
+        return inliers
+
+    def _queryData(self, tree, k):
+        """
+        Closest points in tree to each data point, as (len(data), k)
+        arrays of distances and indices.
+        """
+        n = len(self.data)
+        if self.dtype == np.float64:
+            d, i = tree.query(self.data, k=k, **self.treeArgs)
+            return d.reshape((n, k)), i.reshape((n, k))
+
+        d = np.empty((n, k), dtype=self.dtype)
+        i = np.empty((n, k), dtype=np.intp)
+        for start in range(0, n, QUERY_CHUNK_SIZE):
+            end = min(start + QUERY_CHUNK_SIZE, n)
+            dChunk, iChunk = tree.query(self.data[start:end], k=k, **self.treeArgs)
+            d[start:end] = dChunk.reshape((end - start, k))
+            i[start:end] = iChunk.reshape((end - start, k))
+        return d, i
+
+    def __call__(self, x, out=None, weighted=True):
+        if out is None:
+            out = np.empty(self.nResiduals)
+        row = 0
+        for term, ep, d, i, inliers, w in self._search(x):
+            m = out[row:row + len(d)]
+            np.mean(d, 1, out=m)
+            np.multiply(m, m, out=m)
+            if weighted and (w is not None):
+                m *= np.sqrt(w)
+            if inliers is not None:
+                m[~inliers] = 0.0
+            row += len(d)
+        return out
+
+    def correspondences(self, x):
+        """
+        Slave mesh points at x and the mean of the nClosestPoints closest
+        data points to each, as (number of points, 3) arrays, and the
+        weight of each point, 0 if rejected as an outlier, or None if
+        there are no weights or outliers. EPDP mode only.
+        """
+        term, ep, d, i, inliers, w = self._search(x)[0]
+        if inliers is not None:
+            w = inliers.astype(float) if w is None else w * inliers
+        i = np.minimum(i, len(self.data) - 1)
+        return ep.astype(float), self.data[i].mean(1, dtype=float), w
+
+    def jacobian(self, x):
+        k = self.nClosestPoints
+        blocks = []
+        for term, ep, d, i, inliers, w in self._search(x):
+            m = d.mean(1)
+            # d(m^2)/d(ep) = 2m/k * sum of unit vectors from data to ep
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = np.where(d > 0.0, (2.0 * m / k)[:, np.newaxis] / d, 0.0)
+            scale[~np.isfinite(scale)] = 0.0
+            if w is not None:
+                scale *= np.sqrt(w).astype(self.dtype)[:, np.newaxis]
+            if inliers is not None:
+                scale[~inliers] = 0.0
+            if term == 'EPDP':
+                # points with no neighbour within the query distance bound
+                # are given the index len(data)
+                i = np.minimum(i, len(self.data) - 1)
+                v = np.subtract(ep[:, np.newaxis, :], self.data[i], dtype=self.dtype)
+                v *= scale[:, :, np.newaxis]
+                blocks.append(_dimBlocks([v.sum(1)], [self.A]))
+            else:
+                i = np.minimum(i, len(ep) - 1)
+                v = np.subtract(ep[i], self.data[:, np.newaxis, :], dtype=self.dtype)
+                v *= scale[:, :, np.newaxis]
+                blocks.append(_dimBlocks([v[:, n] for n in range(k)],
+                                         [self.A[i[:, n]] for n in range(k)]))
+
+        return sparse.vstack(blocks, format='csr')
+
+
+class SobolevPenalty(object):
+    '''
+    Weighted sum of squared field derivatives at a regular xi
+    discretisation evalD of every element, or of elements if given, as
+    makeSobelovPenalty2D and makeSobelovPenalty3D. weights has one entry
+    per derivative.
+    '''
+
+    def __init__(self, gf, evalD, weights, elements=None):
+        self.D = cache.basisMatrixCache.getMatrices(gf, 'derivatives', evalD, basis.derivativeMatrices, elements)
+        self.weights = np.asarray(weights, dtype=float)
+        self.nResiduals = self.D[0].shape[0]
+        self._sq = np.empty(self.nResiduals)
+
+    def __call__(self, x, out=None):
+        if out is None:
+            out = np.empty(self.nResiduals)
+        P = np.asarray(x).reshape((3, -1)).T
+        out[:] = 0.0
+        for w, Dk in zip(self.weights, self.D):
+            v = Dk.dot(P)
+            np.einsum('ij,ij->i', v, v, out=self._sq)
+            self._sq *= w
+            out += self._sq
+        return out
+
+    def jacobian(self, x):
+        P = np.asarray(x).reshape((3, -1)).T
+        scales = [2.0 * w * Dk.dot(P) for w, Dk in zip(self.weights, self.D)]
+        return _dimBlocks(scales, self.D)
+
+
+def _edgeDerivativeMatrices(gf, D, elements=None):
+    """
+    Matrices of the xi1 and xi2 basis derivatives of the first and of
+    the second element at D points along each shared element edge, or
+    each edge with at least one of its elements in elements if given.
+    """
+    f = gf.ensemble_field_function.flatten()[0]
+    smoother = GFF.normalSmoother2(f)
+    smoother._procEdge(D)
+
+    elements = None if elements is None else set(elements)
+    blocks = ([], [], [], [])
+    row = 0
+    for e1, b1, e2, b2 in smoother.edgeEvalBasis:
+        if (elements is not None) and (e1 not in elements) and (e2 not in elements):
+            continue
+        nodes1 = np.array([smoother.el2en[e1][n][0][0] for n in range(b1[0].shape[1])])
+        nodes2 = np.array([smoother.el2en[e2][n][0][0] for n in range(b2[0].shape[1])])
+        blocks[0].append((row, nodes1, b1[0]))
+        blocks[1].append((row, nodes1, b1[1]))
+        blocks[2].append((row, nodes2, b2[0]))
+        blocks[3].append((row, nodes2, b2[1]))
+        row += b1[0].shape[0]
+
+    nNodes = f.get_number_of_ensemble_points()
+    return [basis.assembleMatrix(b, row, nNodes) for b in blocks]
+
+
+class NormalPenalty(object):
+    '''
+    1 - n1.n2 for the normals n1 and n2 on either side of each shared
+    element edge, evaluated at D points along each edge, as
+    normalSmoother2.makeObj. If elements is given, only the edges of
+    those elements are evaluated, including those they share with
+    other elements so that the region stays smooth at its boundary.
+    '''
+
+    def __init__(self, gf, D, elements=None):
+        self.A1dxi1, self.A1dxi2, self.A2dxi1, self.A2dxi2 = \
+            cache.basisMatrixCache.getMatrices(gf, 'edge derivatives', D, _edgeDerivativeMatrices, elements)
+        self.nResiduals = self.A1dxi1.shape[0]
+
+    def _normals(self, x):
+        P = np.asarray(x).reshape((3, -1)).T
+        a1 = self.A1dxi1.dot(P)
+        b1 = self.A1dxi2.dot(P)
+        a2 = self.A2dxi1.dot(P)
+        b2 = self.A2dxi2.dot(P)
+        c1 = np.cross(a1, b1)
+        c2 = np.cross(a2, b2)
+        l1 = np.sqrt((c1 * c1).sum(1))[:, np.newaxis]
+        l2 = np.sqrt((c2 * c2).sum(1))[:, np.newaxis]
+        return a1, b1, c1 / l1, l1, a2, b2, c2 / l2, l2
+
+    def __call__(self, x, out=None):
+        if out is None:
+            out = np.empty(self.nResiduals)
+        n1, n2 = self._normals(x)[2::4]
+        np.einsum('ij,ij->i', n1, n2, out=out)
+        np.subtract(1.0, out, out=out)
+        return out
+
+    def jacobian(self, x):
+        a1, b1, n1, l1, a2, b2, n2, l2 = self._normals(x)
+        cos = (n1 * n2).sum(1)[:, np.newaxis]
+        # gradient of n1.n2 with respect to the unnormalised normals
+        g1 = (n2 - cos * n1) / l1
+        g2 = (n1 - cos * n2) / l2
+        scales = [-np.cross(b1, g1), -np.cross(g1, a1), -np.cross(b2, g2), -np.cross(g2, a2)]
+        return _dimBlocks(scales, [self.A1dxi1, self.A1dxi2, self.A2dxi1, self.A2dxi2])
+
+
+class SlaveObjective(object):
+    '''
+    The full slave mesh objective: data term, Sobolev penalty and
+    weighted normal penalty.
+
+    Residuals are written in place into one preallocated buffer, which
+    is returned by each call and so is overwritten by the next call.
+    slices maps the term names 'data', 'sobolev' and 'normal' to their
+    slices of the buffer, and terms() returns views of the last
+    residuals of each term.
+
+    If profile is set to a profiling.FitProfile, the time and residuals
+    of each term are recorded in it under the term names.
+    '''
+
+    def __init__(self, dataObj, sobObj, normObj, normWeight):
+        self.dataObj = dataObj
+        self.sobObj = sobObj
+        self.normObj = normObj
+        self.normWeight = normWeight
+        self.profile = None
+
+        self.slices = {}
+        row = 0
+        for name, obj in (('data', dataObj), ('sobolev', sobObj), ('normal', normObj)):
+            self.slices[name] = slice(row, row + obj.nResiduals)
+            row += obj.nResiduals
+        self.nResiduals = row
+        self.residuals = np.zeros(self.nResiduals)
+
+    def terms(self):
+        """
+        Return a dictionary of views of the last residuals of each term.
+        """
+        return dict((name, self.residuals[s]) for name, s in self.slices.items())
+
+    def __call__(self, x):
+        if self.profile is not None:
+            return self._profiledCall(x)
+        self.dataObj(x, out=self.residuals[self.slices['data']])
+        self.sobObj(x, out=self.residuals[self.slices['sobolev']])
+        errNorm = self.normObj(x, out=self.residuals[self.slices['normal']])
+        errNorm *= self.normWeight
+        return self.residuals
+
+    def _profiledCall(self, x):
+        for name, obj in (('data', self.dataObj), ('sobolev', self.sobObj), ('normal', self.normObj)):
+            t0 = time.perf_counter()
+            err = obj(x, out=self.residuals[self.slices[name]])
+            if name == 'normal':
+                err *= self.normWeight
+            self.profile.record(name, time.perf_counter() - t0, err)
+        return self.residuals
+
+    def penalties(self, x):
+        """
+        Residuals and Jacobian of the Sobolev penalty and the weighted
+        normal penalty at x.
+        """
+        r = np.hstack([self.sobObj(x), self.normObj(x) * self.normWeight])
+        J = sparse.vstack([self.sobObj.jacobian(x), self.normObj.jacobian(x) * self.normWeight], format='csr')
+        return r, J
+
+    def jacobian(self, x):
+        # in the precision of the data term, the largest block
+        return sparse.vstack([
+            self.dataObj.jacobian(x),
+            self.sobObj.jacobian(x),
+            self.normObj.jacobian(x) * self.normWeight,
+        ], format='csr', dtype=self.dataObj.dtype)
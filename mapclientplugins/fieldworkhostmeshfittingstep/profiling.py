@@ -0,0 +1,84 @@
+'''
+Timing of the terms of the host mesh fit objective.
+
+A FitProfile records the wall time and residual norm of each call to a
+named part of the fit, e.g. the slave mesh data term or the host mesh
+solver, so that the cost of a slow fit can be attributed to its terms.
+'''
+import time
+
+import numpy as np
+
+# order of the rows of formatReport, other names follow in the
+# order they were first recorded
+PROFILE_NAMES = ('data', 'sobolev', 'normal', 'slave objective', 'jacobian', 'solver',
+                 'correspondence', 'linear solve', 'outer iteration', 'stage')
+
+
+def _ordered(names):
+    return [n for n in PROFILE_NAMES if n in names] + [n for n in names if n not in PROFILE_NAMES]
+
+
+class FitProfile(object):
+    '''
+    Call counts, call times and residual norms of named parts of a fit.
+    '''
+
+    def __init__(self):
+        self.times = {}
+        self.norms = {}
+
+    def record(self, name, seconds, residuals=None):
+        """
+        Record a call to name that took seconds. If residuals are given,
+        their 2-norm is recorded as well.
+        """
+        self.times.setdefault(name, []).append(seconds)
+        if residuals is not None:
+            self.norms.setdefault(name, []).append(np.sqrt(np.dot(residuals, residuals)))
+
+    def timer(self, name):
+        """
+        Return a function that records a call to name that started now,
+        e.g. stop = profile.timer('stage'); ...; stop()
+        """
+        t0 = time.perf_counter()
+
+        def stop(residuals=None):
+            self.record(name, time.perf_counter() - t0, residuals)
+
+        return stop
+
+    def report(self):
+        """
+        Return a dictionary of the statistics of each name recorded:
+        calls, total, mean, p50, p90 and p99 times in seconds and, for
+        names recorded with residuals, the last and mean residual norms.
+        """
+        report = {}
+        for name in _ordered(self.times):
+            t = np.array(self.times[name])
+            p50, p90, p99 = np.percentile(t, [50, 90, 99])
+            stats = {'calls': len(t), 'total': float(t.sum()), 'mean': float(t.mean()),
+                     'p50': float(p50), 'p90': float(p90), 'p99': float(p99)}
+            if name in self.norms:
+                stats['last norm'] = float(self.norms[name][-1])
+                stats['mean norm'] = float(np.mean(self.norms[name]))
+            report[name] = stats
+        return report
+
+
+def formatReport(report):
+    """
+    Format a FitProfile report as a text table, with times in
+    milliseconds except for the total in seconds.
+    """
+    lines = ['{:<16}{:>7}{:>10}{:>9}{:>9}{:>9}{:>9}{:>12}'.format(
+        'term', 'calls', 'total s', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'last norm')]
+    for name in _ordered(report):
+        s = report[name]
+        norm = '{:.4g}'.format(s['last norm']) if 'last norm' in s else '-'
+        lines.append('{:<16}{:>7}{:>10.3f}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}{:>12}'.format(
+            name, s['calls'], s['total'], 1e3 * s['mean'], 1e3 * s['p50'], 1e3 * s['p90'],
+            1e3 * s['p99'], norm))
+    return '\n'.join(lines)
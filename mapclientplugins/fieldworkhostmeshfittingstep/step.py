@@ -2,6 +2,7 @@
 MAP Client Plugin Step
 '''
 import json
+import os
 
 from PySide6 import QtGui
 
@@ -9,10 +10,12 @@ from mapclient.mountpoints.workflowstep import WorkflowStepMountPoint
 from mapclientplugins.fieldworkhostmeshfittingstep.configuredialog import ConfigureDialog
 from mapclientplugins.fieldworkhostmeshfittingstep.mayavihostmeshfittingviewerwidget import \
     MayaviHostMeshFittingViewerWidget
+from mapclientplugins.fieldworkhostmeshfittingstep import fitting
+from mapclientplugins.fieldworkhostmeshfittingstep import cache
+from mapclientplugins.fieldworkhostmeshfittingstep import checkpoint
+from mapclientplugins.fieldworkhostmeshfittingstep import decimation
+from mapclientplugins.fieldworkhostmeshfittingstep import profiling
 
-import copy
-from gias3.fieldwork.field.tools import fitting_tools
-from gias3.fieldwork.field import geometric_field_fitter as GFF
 import numpy as np
 
 
@@ -25,19 +28,7 @@ class FieldworkHostMeshFittingStep(WorkflowStepMountPoint):
     _configDefaults = {}
     _configDefaults['identifier'] = ''
     _configDefaults['GUI'] = 'True'
-    _configDefaults['fit mode'] = 'DPEP'
-    _configDefaults['host element type'] = 'quad444'
-    _configDefaults['slave mesh discretisation'] = '[10,10]'
-    _configDefaults['slave sobelov discretisation'] = '[8,8]'
-    _configDefaults['slave sobelov weight'] = '[1e-6, 1e-6, 1e-6, 1e-6, 2e-6]'
-    _configDefaults['slave normal discretisation'] = '8'
-    _configDefaults['slave normal weight'] = '50.0'
-    _configDefaults['max iterations'] = '10'
-    _configDefaults['host sobelov discretisation'] = '[8,8,8]'
-    _configDefaults['host sobelov weight'] = '1e-5'
-    _configDefaults['n closest points'] = '1'
-    _configDefaults['kdtree args'] = '{}'
-    _configDefaults['verbose'] = 'True'
+    _configDefaults.update(fitting.FIT_CONFIG_DEFAULTS)
 
     def __init__(self, location):
         super(FieldworkHostMeshFittingStep, self).__init__('Fieldwork Host Mesh Fitting', location)
@@ -98,17 +89,22 @@ class FieldworkHostMeshFittingStep(WorkflowStepMountPoint):
 
         self.data = None
         self.dataWeights = None
+        self._fitData = {}
+        self._dataTrees = {}
+        self._dataHash = None
         self.slaveGFUnfitted = None
         self.slaveGF = None
         self.slaveGFFitted = None
         self.RMSEFitted = None
         self.slaveGFParamsFitted = None
         self.fitErrors = None
+        self.fitProfile = None
         self.hostGFUnfitted = None
         self.hostGF = None
         self.hostGFFitted = None
         self._genHostGF = True
         self._hostGFType = None
+        self._slaveXi = None
 
         self._widget = None
 
@@ -127,98 +123,208 @@ class FieldworkHostMeshFittingStep(WorkflowStepMountPoint):
             # self._widget._ui.registerButton.clicked.connect(self._register)
             self._widget._ui.acceptButton.clicked.connect(self._doneExecution)
             self._widget._ui.abortButton.clicked.connect(self._abort)
-            self._widget._ui.resetButton.clicked.connect(self._reset)
+            # the widget resets the step through _reset once any running
+            # fit has stopped
             self._setCurrentWidget(self._widget)
 
         elif self._config['GUI'] == 'False':
             self._fit()
-            self.slaveGFFitted = copy.deepcopy(self.slaveGF)
             self._doneExecution()
 
     def _parseFitConfigs(self):
-        """
-        sanitisation should be done here
-        """
-        args = {}
-        args['fit mode'] = self._config['fit mode']
-        args['verbose'] = self._config['verbose']
-        args['host element type'] = self._config['host element type']
-        args['slave mesh discretisation'] = eval(self._config['slave mesh discretisation'])
-        args['slave sobelov discretisation'] = eval(self._config['slave sobelov discretisation'])
-        args['slave sobelov weight'] = eval(self._config['slave sobelov weight'])
-        args['slave normal discretisation'] = eval(self._config['slave normal discretisation'])
-        args['slave normal weight'] = float(self._config['slave normal weight'])
-        args['host sobelov discretisation'] = eval(self._config['host sobelov discretisation'])
-        args['host sobelov weight'] = float(self._config['host sobelov weight'])
-        args['max iterations'] = int(self._config['max iterations'])
-        args['slave mesh discretisation'] = eval(self._config['slave mesh discretisation'])
-        args['n closest points'] = int(self._config['n closest points'])
-        args['kdtree args'] = eval(self._config['kdtree args'])
-
-        return args
+        return fitting.parseFitConfigs(self._config)
 
     def _initHostGF(self, hostElementType):
         # make host GF if one is not provided
         if self._genHostGF:
-            print('creating host mesh of type', hostElementType)
-            self.hostGF = GFF.makeHostMesh(self.slaveGFUnfitted.get_field_parameters(), \
-                                           5.0, hostElementType)
-            self.hostGFUnfitted = copy.deepcopy(self.hostGF)
-
-    def _fit(self, callback=None):
+            self.hostGF = fitting.makeHostGF(self.slaveGFUnfitted, hostElementType)
+            self.hostGFUnfitted = cache.copyGF(self.hostGF)
 
+    def _fit(self, callback=None, cancelToken=None):
+        """
+        Run the host mesh fit. callback, if given, receives the progress
+        of the fit, see fitting.ObjectiveMonitor. If cancelToken is
+        cancelled, or the configured timeout passes, the fit stops and
+        the best fit so far is output. If cancelToken is cancelled while
+        the host mesh or the fit data are prepared, a
+        fitting.FitCancelledError is raised instead.
+
+        If the profile config is True, the last output is the report of
+        a profiling.FitProfile of the fit, otherwise None.
+
+        If the result cache size is not 0, the results of cold-started
+        fits that run to completion are saved in the step cache
+        directory, and a fit of the same inputs and configs loads the
+        saved result instead of fitting again.
+
+        If the checkpoint config is True, cold-started fits save a
+        checkpoint in the step cache directory after each outer
+        iteration, and a fit of the same inputs and configs resumes from
+        it. The checkpoint is deleted once the fit completes.
+        """
         args = self._parseFitConfigs()
-        self._initHostGF(args['host element type'])
-        # make slave obj
-        if args['fit mode'] == 'DPEP':
-            slaveGObj = GFF.makeObjDPEP(self.slaveGF, self.data, args['slave mesh discretisation'],
-                                        n_closest_points=args['n closest points'],
-                                        tree_args=args['kdtree args'])
-        elif args['fit mode'] == 'EPDP':
-            slaveGObj = GFF.makeObjEPDP(self.slaveGF, self.data, args['slave mesh discretisation'],
-                                        n_closest_points=args['n closest points'],
-                                        tree_args=args['kdtree args'])
-        elif args['fit mode'] == '2way':
-            slaveGObj = GFF.makeObj2Way(self.slaveGF, self.data, args['slave mesh discretisation'],
-                                        n_closest_points=args['n closest points'],
-                                        tree_args=args['kdtree args'])
-
-        slaveSobObj = GFF.makeSobelovPenalty2D(self.slaveGF, args['slave sobelov discretisation'],
-                                               args['slave sobelov weight'])
-        slaveNormalSmoother = GFF.normalSmoother2(self.slaveGF.ensemble_field_function.flatten()[0])
-        slaveNormObj = slaveNormalSmoother.makeObj(args['slave normal discretisation'])
-
-        def slaveObj(x):
-            errSurface = slaveGObj(x)
-            errSob = slaveSobObj(x)
-            errNorm = slaveNormObj(x) * args['slave normal weight']
-            return np.hstack([errSurface, errSob, errNorm])
-
-        # run HMF
-        hostParamsOpt, slaveParamsOpt, \
-        slaveXi, RMSEFitted = fitting_tools.hostMeshFitMulti(
-            self.hostGF, self.slaveGF, slaveObj,
-            max_it=args['max iterations'],
-            sob_d=args['host sobelov discretisation'],
-            sob_w=args['host sobelov weight'],
-            verbose=args['verbose'],
-            xtol=1e-6,
-        )
+        if cancelToken is None:
+            cancelToken = fitting.CancelToken()
+        resultKey = None
+        if args['warm start'] and self._canWarmStart(args):
+            # start from the last converged host and the slave xi found for it
+            self.hostGF.set_field_parameters(self.hostGFFitted.get_field_parameters())
+            slaveXi = self._slaveXi
+        else:
+            self._initHostGF(args['host element type'])
+            cancelToken.check()
+            slaveXi = None
+            if (args['result cache size'] > 0) or args['checkpoint']:
+                resultKey = self._getFitResultKey(args)
+
+        result = None
+        if (resultKey is not None) and (args['result cache size'] > 0):
+            result = cache.fitResultCache.load(resultKey, self._getCacheDir())
+
+        if result is not None:
+            if args['verbose']:
+                print('loaded cached fit result', resultKey)
+            slaveParamsOpt = self._setFitResult(result)
+        else:
+            profile = profiling.FitProfile() if args['profile'] else None
+            fitCheckpoint = None
+            if (resultKey is not None) and args['checkpoint']:
+                fitCheckpoint = checkpoint.FitCheckpoint(
+                    os.path.join(self._getCacheDir(), 'checkpoint-{}.npz'.format(resultKey)))
+                fitCheckpoint.load()
+
+            # run HMF
+            stages = []
+            for stageArgs in args.stages:
+                stages.append((self._getFitData(stageArgs), stageArgs, self._getDataTree(stageArgs),
+                               self._getFitWeights(stageArgs)))
+                # decimation and KD-trees of large point clouds take a while
+                cancelToken.check()
+            hostParamsOpt, slaveParamsOpt, self._slaveXi, \
+            self.RMSEFitted, self.fitErrors = fitting.hostMeshFitStages(
+                stages, self.slaveGF, self.hostGF, slaveXi=slaveXi,
+                timeout=args['timeout'] or None, callback=callback, cancelToken=cancelToken,
+                errorData=None if stages[-1][0] is self.data else self.data,
+                profile=profile, checkpoint=fitCheckpoint, errorWeights=self.dataWeights
+            )
+            self.fitProfile = None if profile is None else profile.report()
+            if self.fitProfile is not None and args['verbose']:
+                print(profiling.formatReport(self.fitProfile))
+
+            if not cancelToken.isCancelled():
+                if fitCheckpoint is not None:
+                    fitCheckpoint.remove()
+                if (resultKey is not None) and (args['result cache size'] > 0):
+                    cache.fitResultCache.save(resultKey, self._getFitResult(slaveParamsOpt),
+                                              self._getCacheDir(), args['result cache size'] * 1024 ** 2)
+
+        self._hostGFType = args['host element type']
 
         # prepare outputs
-        self.slaveGF.set_field_parameters(slaveParamsOpt)
-        self.hostGF.set_field_parameters(hostParamsOpt)
-
-        self.slaveGFFitted = copy.deepcopy(self.slaveGF)
+        self.slaveGFFitted = cache.copyGF(self.slaveGF)
         self.slaveGFParamsFitted = slaveParamsOpt.copy()
-        self.fitErrors = np.sqrt(slaveGObj(slaveParamsOpt))
-        self.RMSEFitted = np.sqrt((self.fitErrors ** 2.0).mean())
-        self.hostGFFitted = copy.deepcopy(self.hostGF)
+        self.hostGFFitted = cache.copyGF(self.hostGF)
 
         # self._genHostGF = True
 
         return self.slaveGFFitted, self.slaveGFParamsFitted, self.RMSEFitted, \
-               self.fitErrors, self.hostGFFitted
+               self.fitErrors, self.hostGFFitted, self.fitProfile
+
+    def _getFitData(self, args):
+        """
+        Target data to fit, decimated as configured for a fit stage. The
+        decimated data are kept until the input data or weights change.
+        """
+        key = (args['decimation voxel size'], args['decimation disk radius'])
+        if key not in self._fitData:
+            self._fitData[key] = decimation.decimate(
+                self.data, self.dataWeights, voxelSize=key[0], diskRadius=key[1], verbose=args['verbose']
+            )
+        return self._fitData[key][0]
+
+    def _getFitWeights(self, args):
+        """
+        Weights of the target data returned by _getFitData.
+        """
+        self._getFitData(args)
+        key = (args['decimation voxel size'], args['decimation disk radius'])
+        return self._fitData[key][1]
+
+    def _getDataTree(self, args):
+        """
+        KD-tree of the target data to fit for the EPDP, 2way and ICP fit
+        modes.
+        Trees are shared between fits of the same data and, if 'kdtree
+        cache' is True, saved in the step cache directory.
+        """
+        if fitting.dataTermMode(args['fit mode']) not in ('EPDP', '2way'):
+            return None
+        key = (args['decimation voxel size'], args['decimation disk radius'])
+        if key not in self._dataTrees:
+            cacheDir = self._getCacheDir() if args['kdtree cache'] else None
+            self._dataTrees[key] = cache.kdTreeCache.getTree(self._getFitData(args), cacheDir=cacheDir)
+        return self._dataTrees[key]
+
+    def _getFitResultKey(self, args):
+        """
+        Key of the fit result cache for a fit of the current data,
+        weights, slave mesh and starting host mesh with args.
+        """
+        if self._dataHash is None:
+            self._dataHash = cache.hashArray(self.data)
+        hashes = [self._dataHash,
+                  None if self.dataWeights is None else cache.hashArray(self.dataWeights),
+                  cache.hashArray(self.slaveGF.field_parameters),
+                  cache.hashArray(self.hostGF.field_parameters)]
+        return cache.FitResultCache.key(hashes, fitting.resultConfig(args))
+
+    def _getFitResult(self, slaveParamsOpt):
+        """
+        Arrays of the last fit for the fit result cache.
+        """
+        slaveXiElements, slaveXi = cache.packSlaveXi(self._slaveXi)
+        return {
+            'slaveParams': slaveParamsOpt,
+            'hostParams': self.hostGF.field_parameters,
+            'slaveXiElements': slaveXiElements,
+            'slaveXi': slaveXi,
+            'RMSE': np.array(self.RMSEFitted),
+            'fitErrors': self.fitErrors,
+        }
+
+    def _setFitResult(self, result):
+        """
+        Set the fitted meshes and errors from a cached fit result and
+        return the fitted slave parameters.
+        """
+        self.slaveGF.set_field_parameters(result['slaveParams'])
+        self.hostGF.set_field_parameters(result['hostParams'])
+        self._slaveXi = cache.unpackSlaveXi(result['slaveXiElements'], result['slaveXi'])
+        self.RMSEFitted = float(result['RMSE'])
+        self.fitErrors = result['fitErrors']
+        self.fitProfile = None
+        return result['slaveParams']
+
+    def _getCacheDir(self):
+        return os.path.join(self._location, self._config['identifier'] + '-cache')
+
+    def _canWarmStart(self, args):
+        """
+        A fit can be warm started if there is a previous fit and the host
+        mesh it used would be used again.
+        """
+        if (self.hostGFFitted is None) or (self._slaveXi is None):
+            return False
+        return (not self._genHostGF) or (args['host element type'] == self._hostGFType)
+
+    def _discardPreviousFit(self):
+        """
+        Forget the host mesh and slave xi of the previous fit, so that a
+        fit of new inputs is never warm started from them.
+        """
+        self.hostGFFitted = None
+        self._slaveXi = None
+        self._hostGFType = None
 
     def _abort(self):
         # self._doneExecution()
@@ -229,11 +335,21 @@ class FieldworkHostMeshFittingStep(WorkflowStepMountPoint):
         self.slaveGFParamsFitted = None
         self.RMSEFitted = None
         self.FitErrors = None
-        self.slaveGF = copy.deepcopy(self.slaveGFUnfitted)
+        self.slaveGF = cache.copyGF(self.slaveGFUnfitted)
         self.hostGFFitted = None
-        self.hostGF = copy.deepcopy(self.hostGFUnfitted)
+        self.hostGF = cache.copyGF(self.hostGFUnfitted)
+        self._slaveXi = None
         # self._genHostGF = True
 
+    def _checkDataWeights(self):
+        """
+        Raise a ValueError if the data weights are invalid for the target
+        data, so that they are rejected when a port is set rather than
+        partway through a fit.
+        """
+        if self.dataWeights is not None:
+            decimation.checkWeights(self.dataWeights, None if self.data is None else len(self.data))
+
     def setPortData(self, index, dataIn):
         '''
         Add your code here that will set the appropriate objects for this step.
@@ -242,16 +358,26 @@ class FieldworkHostMeshFittingStep(WorkflowStepMountPoint):
         '''
 
         if index == 0:
-            self.data = np.array(dataIn, dtype=float)  # ju#pointcoordinates
+            self.data = fitting.asFloatArray(dataIn)  # ju#pointcoordinates
+            self._fitData = {}
+            self._dataTrees = {}
+            self._dataHash = None
+            self._discardPreviousFit()
+            self._checkDataWeights()
         elif index == 1:
             self.slaveGF = dataIn  # ju#fieldworkmodel
-            self.slaveGFUnfitted = copy.deepcopy(self.slaveGF)
+            self.slaveGFUnfitted = cache.copyGF(self.slaveGF)
+            self._discardPreviousFit()
         elif index == 2:
-            self.dataWeights = np.array(dataIn, dtype=float)  # numpyarray1d - dataWeights
+            self.dataWeights = fitting.asFloatArray(dataIn)  # numpyarray1d - dataWeights
+            self._fitData = {}
+            self._dataTrees = {}
+            self._checkDataWeights()
         else:
             self.hostGF = dataIn
-            self.hostGFUnfitted = copy.deepcopy(self.hostGF)
+            self.hostGFUnfitted = cache.copyGF(self.hostGF)
             self._genHostGF = False
+            self._discardPreviousFit()
 
     def getPortData(self, index):
         '''
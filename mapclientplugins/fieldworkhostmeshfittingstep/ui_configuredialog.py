@@ -23,7 +23,7 @@ class Ui_ConfigureDialog(object):
     def setupUi(self, ConfigureDialog):
         if not ConfigureDialog.objectName():
             ConfigureDialog.setObjectName(u"ConfigureDialog")
-        ConfigureDialog.resize(418, 539)
+        ConfigureDialog.resize(418, 903)
         self.gridLayout = QGridLayout(ConfigureDialog)
         self.gridLayout.setObjectName(u"gridLayout")
         self.configGroupBox = QGroupBox(ConfigureDialog)
@@ -180,6 +180,146 @@ class Ui_ConfigureDialog(object):
 
         self.formLayout.setWidget(14, QFormLayout.FieldRole, self.lineEdit14)
 
+        self.label15 = QLabel(self.configGroupBox)
+        self.label15.setObjectName(u"label15")
+
+        self.formLayout.setWidget(15, QFormLayout.LabelRole, self.label15)
+
+        self.lineEdit15 = QLineEdit(self.configGroupBox)
+        self.lineEdit15.setObjectName(u"lineEdit15")
+
+        self.formLayout.setWidget(15, QFormLayout.FieldRole, self.lineEdit15)
+
+        self.label16 = QLabel(self.configGroupBox)
+        self.label16.setObjectName(u"label16")
+
+        self.formLayout.setWidget(16, QFormLayout.LabelRole, self.label16)
+
+        self.lineEdit16 = QLineEdit(self.configGroupBox)
+        self.lineEdit16.setObjectName(u"lineEdit16")
+
+        self.formLayout.setWidget(16, QFormLayout.FieldRole, self.lineEdit16)
+
+        self.label17 = QLabel(self.configGroupBox)
+        self.label17.setObjectName(u"label17")
+
+        self.formLayout.setWidget(17, QFormLayout.LabelRole, self.label17)
+
+        self.lineEdit17 = QLineEdit(self.configGroupBox)
+        self.lineEdit17.setObjectName(u"lineEdit17")
+
+        self.formLayout.setWidget(17, QFormLayout.FieldRole, self.lineEdit17)
+
+        self.label18 = QLabel(self.configGroupBox)
+        self.label18.setObjectName(u"label18")
+
+        self.formLayout.setWidget(18, QFormLayout.LabelRole, self.label18)
+
+        self.lineEdit18 = QLineEdit(self.configGroupBox)
+        self.lineEdit18.setObjectName(u"lineEdit18")
+
+        self.formLayout.setWidget(18, QFormLayout.FieldRole, self.lineEdit18)
+
+        self.label19 = QLabel(self.configGroupBox)
+        self.label19.setObjectName(u"label19")
+
+        self.formLayout.setWidget(19, QFormLayout.LabelRole, self.label19)
+
+        self.lineEdit19 = QLineEdit(self.configGroupBox)
+        self.lineEdit19.setObjectName(u"lineEdit19")
+
+        self.formLayout.setWidget(19, QFormLayout.FieldRole, self.lineEdit19)
+
+        self.label20 = QLabel(self.configGroupBox)
+        self.label20.setObjectName(u"label20")
+
+        self.formLayout.setWidget(20, QFormLayout.LabelRole, self.label20)
+
+        self.lineEdit20 = QLineEdit(self.configGroupBox)
+        self.lineEdit20.setObjectName(u"lineEdit20")
+
+        self.formLayout.setWidget(20, QFormLayout.FieldRole, self.lineEdit20)
+
+        self.label21 = QLabel(self.configGroupBox)
+        self.label21.setObjectName(u"label21")
+
+        self.formLayout.setWidget(21, QFormLayout.LabelRole, self.label21)
+
+        self.lineEdit21 = QLineEdit(self.configGroupBox)
+        self.lineEdit21.setObjectName(u"lineEdit21")
+
+        self.formLayout.setWidget(21, QFormLayout.FieldRole, self.lineEdit21)
+
+        self.label22 = QLabel(self.configGroupBox)
+        self.label22.setObjectName(u"label22")
+
+        self.formLayout.setWidget(22, QFormLayout.LabelRole, self.label22)
+
+        self.lineEdit22 = QLineEdit(self.configGroupBox)
+        self.lineEdit22.setObjectName(u"lineEdit22")
+
+        self.formLayout.setWidget(22, QFormLayout.FieldRole, self.lineEdit22)
+
+        self.label23 = QLabel(self.configGroupBox)
+        self.label23.setObjectName(u"label23")
+
+        self.formLayout.setWidget(23, QFormLayout.LabelRole, self.label23)
+
+        self.lineEdit23 = QLineEdit(self.configGroupBox)
+        self.lineEdit23.setObjectName(u"lineEdit23")
+
+        self.formLayout.setWidget(23, QFormLayout.FieldRole, self.lineEdit23)
+
+        self.label24 = QLabel(self.configGroupBox)
+        self.label24.setObjectName(u"label24")
+
+        self.formLayout.setWidget(24, QFormLayout.LabelRole, self.label24)
+
+        self.lineEdit24 = QLineEdit(self.configGroupBox)
+        self.lineEdit24.setObjectName(u"lineEdit24")
+
+        self.formLayout.setWidget(24, QFormLayout.FieldRole, self.lineEdit24)
+
+        self.label25 = QLabel(self.configGroupBox)
+        self.label25.setObjectName(u"label25")
+
+        self.formLayout.setWidget(25, QFormLayout.LabelRole, self.label25)
+
+        self.lineEdit25 = QLineEdit(self.configGroupBox)
+        self.lineEdit25.setObjectName(u"lineEdit25")
+
+        self.formLayout.setWidget(25, QFormLayout.FieldRole, self.lineEdit25)
+
+        self.label26 = QLabel(self.configGroupBox)
+        self.label26.setObjectName(u"label26")
+
+        self.formLayout.setWidget(26, QFormLayout.LabelRole, self.label26)
+
+        self.lineEdit26 = QLineEdit(self.configGroupBox)
+        self.lineEdit26.setObjectName(u"lineEdit26")
+
+        self.formLayout.setWidget(26, QFormLayout.FieldRole, self.lineEdit26)
+
+        self.label27 = QLabel(self.configGroupBox)
+        self.label27.setObjectName(u"label27")
+
+        self.formLayout.setWidget(27, QFormLayout.LabelRole, self.label27)
+
+        self.lineEdit27 = QLineEdit(self.configGroupBox)
+        self.lineEdit27.setObjectName(u"lineEdit27")
+
+        self.formLayout.setWidget(27, QFormLayout.FieldRole, self.lineEdit27)
+
+        self.label28 = QLabel(self.configGroupBox)
+        self.label28.setObjectName(u"label28")
+
+        self.formLayout.setWidget(28, QFormLayout.LabelRole, self.label28)
+
+        self.lineEdit28 = QLineEdit(self.configGroupBox)
+        self.lineEdit28.setObjectName(u"lineEdit28")
+
+        self.formLayout.setWidget(28, QFormLayout.FieldRole, self.lineEdit28)
+
 
         self.gridLayout.addWidget(self.configGroupBox, 0, 0, 1, 1)
 
@@ -216,5 +356,19 @@ class Ui_ConfigureDialog(object):
         self.label12.setText(QCoreApplication.translate("ConfigureDialog", u"n closest points:  ", None))
         self.label13.setText(QCoreApplication.translate("ConfigureDialog", u"kdtree args:  ", None))
         self.label14.setText(QCoreApplication.translate("ConfigureDialog", u"verbose:  ", None))
+        self.label15.setText(QCoreApplication.translate("ConfigureDialog", u"warm start:  ", None))
+        self.label16.setText(QCoreApplication.translate("ConfigureDialog", u"kdtree cache:  ", None))
+        self.label17.setText(QCoreApplication.translate("ConfigureDialog", u"analytic jacobian:  ", None))
+        self.label18.setText(QCoreApplication.translate("ConfigureDialog", u"timeout:  ", None))
+        self.label19.setText(QCoreApplication.translate("ConfigureDialog", u"decimation voxel size:  ", None))
+        self.label20.setText(QCoreApplication.translate("ConfigureDialog", u"decimation disk radius:  ", None))
+        self.label21.setText(QCoreApplication.translate("ConfigureDialog", u"profile:  ", None))
+        self.label22.setText(QCoreApplication.translate("ConfigureDialog", u"result cache size:  ", None))
+        self.label23.setText(QCoreApplication.translate("ConfigureDialog", u"checkpoint:  ", None))
+        self.label24.setText(QCoreApplication.translate("ConfigureDialog", u"precision:  ", None))
+        self.label25.setText(QCoreApplication.translate("ConfigureDialog", u"query workers:  ", None))
+        self.label26.setText(QCoreApplication.translate("ConfigureDialog", u"trim fraction:  ", None))
+        self.label27.setText(QCoreApplication.translate("ConfigureDialog", u"trim MAD:  ", None))
+        self.label28.setText(QCoreApplication.translate("ConfigureDialog", u"fit elements:  ", None))
     # retranslateUi
 
@@ -17,9 +17,9 @@ from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
     QPalette, QPixmap, QRadialGradient, QTransform)
 from PySide6.QtWidgets import (QApplication, QDialog, QFormLayout, QFrame,
     QGridLayout, QGroupBox, QHBoxLayout, QHeaderView,
-    QLabel, QLayout, QLineEdit, QPushButton,
-    QSizePolicy, QSpacerItem, QTableWidget, QTableWidgetItem,
-    QVBoxLayout, QWidget)
+    QLabel, QLayout, QLineEdit, QPlainTextEdit,
+    QPushButton, QSizePolicy, QSpacerItem, QTableWidget,
+    QTableWidgetItem, QVBoxLayout, QWidget)
 
 from gias3.mapclientpluginutilities.viewers.mayaviscenewidget import MayaviSceneWidget
 
@@ -85,8 +85,8 @@ class Ui_Dialog(object):
             self.fitParamsTableWidget.setColumnCount(1)
         __qtablewidgetitem2 = QTableWidgetItem()
         self.fitParamsTableWidget.setHorizontalHeaderItem(0, __qtablewidgetitem2)
-        if (self.fitParamsTableWidget.rowCount() < 13):
-            self.fitParamsTableWidget.setRowCount(13)
+        if (self.fitParamsTableWidget.rowCount() < 24):
+            self.fitParamsTableWidget.setRowCount(24)
         __qtablewidgetitem3 = QTableWidgetItem()
         self.fitParamsTableWidget.setVerticalHeaderItem(0, __qtablewidgetitem3)
         __qtablewidgetitem4 = QTableWidgetItem()
@@ -114,8 +114,30 @@ class Ui_Dialog(object):
         __qtablewidgetitem15 = QTableWidgetItem()
         self.fitParamsTableWidget.setVerticalHeaderItem(12, __qtablewidgetitem15)
         __qtablewidgetitem16 = QTableWidgetItem()
-        __qtablewidgetitem16.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEditable|Qt.ItemIsDragEnabled|Qt.ItemIsUserCheckable|Qt.ItemIsEnabled);
-        self.fitParamsTableWidget.setItem(2, 0, __qtablewidgetitem16)
+        self.fitParamsTableWidget.setVerticalHeaderItem(13, __qtablewidgetitem16)
+        __qtablewidgetitem17 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(14, __qtablewidgetitem17)
+        __qtablewidgetitem18 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(15, __qtablewidgetitem18)
+        __qtablewidgetitem19 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(16, __qtablewidgetitem19)
+        __qtablewidgetitem20 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(17, __qtablewidgetitem20)
+        __qtablewidgetitem21 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(18, __qtablewidgetitem21)
+        __qtablewidgetitem22 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(19, __qtablewidgetitem22)
+        __qtablewidgetitem23 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(20, __qtablewidgetitem23)
+        __qtablewidgetitem24 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(21, __qtablewidgetitem24)
+        __qtablewidgetitem25 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(22, __qtablewidgetitem25)
+        __qtablewidgetitem26 = QTableWidgetItem()
+        self.fitParamsTableWidget.setVerticalHeaderItem(23, __qtablewidgetitem26)
+        __qtablewidgetitem27 = QTableWidgetItem()
+        __qtablewidgetitem27.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEditable|Qt.ItemIsDragEnabled|Qt.ItemIsUserCheckable|Qt.ItemIsEnabled);
+        self.fitParamsTableWidget.setItem(2, 0, __qtablewidgetitem27)
         self.fitParamsTableWidget.setObjectName(u"fitParamsTableWidget")
 
         self.verticalLayout_2.addWidget(self.fitParamsTableWidget)
@@ -203,6 +225,23 @@ class Ui_Dialog(object):
 
         self.verticalLayout.addWidget(self.errorGroup)
 
+        self.profileGroup = QGroupBox(self.widget)
+        self.profileGroup.setObjectName(u"profileGroup")
+        self.profileLayout = QVBoxLayout(self.profileGroup)
+        self.profileLayout.setObjectName(u"profileLayout")
+        self.profilePlainTextEdit = QPlainTextEdit(self.profileGroup)
+        self.profilePlainTextEdit.setObjectName(u"profilePlainTextEdit")
+        font = QFont()
+        font.setFamilies([u"Monospace"])
+        self.profilePlainTextEdit.setFont(font)
+        self.profilePlainTextEdit.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.profilePlainTextEdit.setReadOnly(True)
+
+        self.profileLayout.addWidget(self.profilePlainTextEdit)
+
+
+        self.verticalLayout.addWidget(self.profileGroup)
+
         self.screenshotgroup = QGroupBox(self.widget)
         self.screenshotgroup.setObjectName(u"screenshotgroup")
         self.screenshotgroup.setAlignment(Qt.AlignLeading|Qt.AlignLeft|Qt.AlignVCenter)
@@ -327,7 +366,29 @@ class Ui_Dialog(object):
         ___qtablewidgetitem14 = self.fitParamsTableWidget.verticalHeaderItem(11)
         ___qtablewidgetitem14.setText(QCoreApplication.translate("Dialog", u"kdtree args", None));
         ___qtablewidgetitem15 = self.fitParamsTableWidget.verticalHeaderItem(12)
-        ___qtablewidgetitem15.setText(QCoreApplication.translate("Dialog", u"verbose", None));
+        ___qtablewidgetitem15.setText(QCoreApplication.translate("Dialog", u"query workers", None));
+        ___qtablewidgetitem16 = self.fitParamsTableWidget.verticalHeaderItem(13)
+        ___qtablewidgetitem16.setText(QCoreApplication.translate("Dialog", u"trim fraction", None));
+        ___qtablewidgetitem17 = self.fitParamsTableWidget.verticalHeaderItem(14)
+        ___qtablewidgetitem17.setText(QCoreApplication.translate("Dialog", u"trim MAD", None));
+        ___qtablewidgetitem18 = self.fitParamsTableWidget.verticalHeaderItem(15)
+        ___qtablewidgetitem18.setText(QCoreApplication.translate("Dialog", u"verbose", None));
+        ___qtablewidgetitem19 = self.fitParamsTableWidget.verticalHeaderItem(16)
+        ___qtablewidgetitem19.setText(QCoreApplication.translate("Dialog", u"warm start", None));
+        ___qtablewidgetitem20 = self.fitParamsTableWidget.verticalHeaderItem(17)
+        ___qtablewidgetitem20.setText(QCoreApplication.translate("Dialog", u"analytic jacobian", None));
+        ___qtablewidgetitem21 = self.fitParamsTableWidget.verticalHeaderItem(18)
+        ___qtablewidgetitem21.setText(QCoreApplication.translate("Dialog", u"timeout", None));
+        ___qtablewidgetitem22 = self.fitParamsTableWidget.verticalHeaderItem(19)
+        ___qtablewidgetitem22.setText(QCoreApplication.translate("Dialog", u"decimation voxel size", None));
+        ___qtablewidgetitem23 = self.fitParamsTableWidget.verticalHeaderItem(20)
+        ___qtablewidgetitem23.setText(QCoreApplication.translate("Dialog", u"decimation disk radius", None));
+        ___qtablewidgetitem24 = self.fitParamsTableWidget.verticalHeaderItem(21)
+        ___qtablewidgetitem24.setText(QCoreApplication.translate("Dialog", u"profile", None));
+        ___qtablewidgetitem25 = self.fitParamsTableWidget.verticalHeaderItem(22)
+        ___qtablewidgetitem25.setText(QCoreApplication.translate("Dialog", u"precision", None));
+        ___qtablewidgetitem26 = self.fitParamsTableWidget.verticalHeaderItem(23)
+        ___qtablewidgetitem26.setText(QCoreApplication.translate("Dialog", u"fit elements", None));
 
         __sortingEnabled = self.fitParamsTableWidget.isSortingEnabled()
         self.fitParamsTableWidget.setSortingEnabled(False)
@@ -341,6 +402,7 @@ class Ui_Dialog(object):
         self.RMSELabel.setText(QCoreApplication.translate("Dialog", u"RMS:", None))
         self.meanErrorLabel.setText(QCoreApplication.translate("Dialog", u"Mean:", None))
         self.SDLabel.setText(QCoreApplication.translate("Dialog", u"S.D.:", None))
+        self.profileGroup.setTitle(QCoreApplication.translate("Dialog", u"Fit Profile", None))
         self.screenshotgroup.setTitle(QCoreApplication.translate("Dialog", u"Screenshot", None))
         self.pixelsXLabel.setText(QCoreApplication.translate("Dialog", u"Pixels X:", None))
         self.screenshotPixelXLineEdit.setText(QCoreApplication.translate("Dialog", u"800", None))
@@ -0,0 +1,39 @@
+import copy
+
+import numpy as np
+
+from mapclientplugins.fieldworkhostmeshfittingstep import benchmark
+from mapclientplugins.fieldworkhostmeshfittingstep import cache
+
+_COPIED_ATTRIBUTES = ('name', 'dimensions', 'points_counter', 'ensemble_point_counter',
+                      'named_points_map', 'basisWeights', 'elementXis',
+                      'ensemble_field_function_filename')
+
+
+def test_copy_gf_matches_deepcopy():
+    gf = benchmark.makeSlaveMesh()
+    gf.elementXis[0] = [np.array([0.5, 0.5])]
+    newGF = cache.copyGF(gf)
+    deepGF = copy.deepcopy(gf)
+    for attribute in _COPIED_ATTRIBUTES:
+        assert repr(getattr(newGF, attribute)) == repr(getattr(deepGF, attribute)), attribute
+    assert len(newGF.points) == len(gf.points)
+    assert newGF.ensemble_field_function is gf.ensemble_field_function
+    np.testing.assert_array_equal(newGF.field_parameters, gf.field_parameters)
+
+
+def test_copy_gf_owns_its_parameters():
+    gf = benchmark.makeSlaveMesh()
+    newGF = cache.copyGF(gf)
+    newGF.field_parameters[:] += 1.0
+    assert not np.allclose(newGF.field_parameters, gf.field_parameters)
+    assert newGF.elementXis is not gf.elementXis
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = cache.LRUCache(maxSize=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    lru.get('a')
+    lru.put('c', 3)
+    assert ('a' in lru) and ('c' in lru) and ('b' not in lru)
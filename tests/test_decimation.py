@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from mapclientplugins.fieldworkhostmeshfittingstep import decimation
+
+
+def _cloud(n=2000, seed=0):
+    return np.random.RandomState(seed).uniform(0.0, 10.0, (n, 3))
+
+
+def test_uniform_weights_match_no_weights():
+    data = _cloud()
+    points, weights = decimation.decimate(data, None, voxelSize=2.0, verbose=False)
+    onesPoints, onesWeights = decimation.decimate(data, np.ones(len(data)), voxelSize=2.0, verbose=False)
+    np.testing.assert_array_equal(points, onesPoints)
+    np.testing.assert_array_equal(weights, onesWeights)
+    assert weights.sum() == len(data)
+
+
+def test_poisson_disk_keeps_total_weight():
+    data = _cloud()
+    w = np.random.RandomState(1).uniform(0.5, 2.0, len(data))
+    points, weights = decimation.decimate(data, w, diskRadius=1.0, verbose=False)
+    assert len(points) < len(data)
+    assert np.isclose(weights.sum(), w.sum())
+
+
+def test_no_decimation_returns_inputs():
+    data = _cloud()
+    points, weights = decimation.decimate(data, None, verbose=False)
+    assert (points is data) and (weights is None)
+
+
+def test_zero_weights_dropped():
+    data = _cloud()
+    w = np.ones(len(data))
+    w[::2] = 0.0
+    points, weights = decimation.dropZeroWeights(data, w)
+    np.testing.assert_array_equal(points, data[1::2])
+
+
+def test_all_zero_weights_raise():
+    data = _cloud()
+    with pytest.raises(ValueError, match='every data weight is 0'):
+        decimation.decimate(data, np.zeros(len(data)), voxelSize=2.0, verbose=False)
+
+
+@pytest.mark.parametrize('weights, nData, message', [
+    (np.ones(10), 2000, '10 data weights for 2000 data points'),
+    (np.array([1.0, -1.0]), None, 'must not be negative'),
+    (np.zeros(5), None, 'every data weight is 0'),
+])
+def test_check_weights_raises(weights, nData, message):
+    with pytest.raises(ValueError, match=message):
+        decimation.checkWeights(weights, nData)
@@ -0,0 +1,96 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from mapclientplugins.fieldworkhostmeshfittingstep import fitting
+
+
+def _config(**values):
+    config = dict(fitting.FIT_CONFIG_DEFAULTS)
+    config.update(values)
+    return config
+
+
+def test_fit_config_defaults():
+    args = fitting.FitConfig(_config())
+    assert args['fit mode'] == 'DPEP'
+    assert args['fit elements'] is None
+    assert len(args.stages) == 1
+
+
+def test_fit_config_error_key():
+    with pytest.raises(fitting.FitConfigError) as e:
+        fitting.FitConfig(_config(**{'max iterations': '-1'}))
+    assert e.value.key == 'max iterations'
+
+
+def test_fit_config_error_pickles():
+    e = fitting.FitConfigError('fit mode', 'XYZ', 'must be one of DPEP, EPDP')
+    e2 = pickle.loads(pickle.dumps(e))
+    assert isinstance(e2, fitting.FitConfigError)
+    assert (e2.key, e2.value, e2.reason) == (e.key, e.value, e.reason)
+    assert str(e2) == str(e)
+
+
+class _SlaveObjective(object):
+    '''
+    Slave objective whose data residuals are the squared parameters.
+    '''
+
+    class dataObj(object):
+        inliers = None
+        residualWeights = None
+
+    def __call__(self, x):
+        self.residuals = np.asarray(x, dtype=float) ** 2
+        return self.residuals
+
+    def terms(self):
+        return {'data': self.residuals}
+
+
+class _HostGF(object):
+
+    def __init__(self):
+        self.params = np.zeros((3, 1, 1))
+
+    def get_field_parameters(self):
+        return self.params
+
+
+def test_objective_monitor_iteration_callback_gets_best_params():
+    calls = []
+    hostGF = _HostGF()
+    monitor = fitting.ObjectiveMonitor(_SlaveObjective(), hostGF, evalsPerIteration=2,
+                                       iterationCallback=lambda *args: calls.append(args))
+    hostGF.params = np.full((3, 1, 1), 1.0)
+    monitor(np.full(3, 1.0))
+    # a worse probe point falls on the iteration
+    hostGF.params = np.full((3, 1, 1), 5.0)
+    monitor(np.full(3, 5.0))
+
+    iteration, slaveParams, hostParams, RMSE = calls[0]
+    assert iteration == 1
+    np.testing.assert_array_equal(slaveParams.ravel(), 1.0)
+    np.testing.assert_array_equal(hostParams.ravel(), 1.0)
+    assert RMSE == 1.0
+
+
+def test_objective_monitor_iteration_done_records_accepted_params():
+    calls = []
+    hostGF = _HostGF()
+    monitor = fitting.ObjectiveMonitor(_SlaveObjective(), hostGF, evalsPerIteration=None,
+                                       iterationCallback=lambda *args: calls.append(args))
+    monitor(np.full(3, 2.0))
+    assert monitor.bestSlaveParams is None
+    hostGF.params = np.full((3, 1, 1), 2.0)
+    monitor.iterationDone(np.full(3, 2.0))
+    # a rejected trial step is evaluated but not recorded
+    monitor(np.full(3, 0.5))
+
+    iteration, slaveParams, hostParams, RMSE = calls[0]
+    assert (iteration, len(calls)) == (1, 1)
+    np.testing.assert_array_equal(monitor.bestSlaveParams.ravel(), 2.0)
+    np.testing.assert_array_equal(hostParams.ravel(), 2.0)
+    assert RMSE == 2.0
@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+import scipy
+
+from mapclientplugins.fieldworkhostmeshfittingstep import basis
+from mapclientplugins.fieldworkhostmeshfittingstep import benchmark
+from mapclientplugins.fieldworkhostmeshfittingstep import fitting
+from mapclientplugins.fieldworkhostmeshfittingstep import objectives
+
+# gias3 evaluates fields and embeds points with scipy.dot, which newer
+# scipy no longer has
+needsGias3Fields = pytest.mark.skipif(not hasattr(scipy, 'dot'),
+                                      reason='gias3 field evaluation needs scipy.dot')
+
+
+def _mesh():
+    return benchmark.makeSlaveMesh(nAround=4, nUp=1)
+
+
+def _params(gf, noise=0.2, seed=1):
+    # away from the cylinder so that the normal penalty is not at its minimum
+    x = gf.get_field_parameters()
+    return (x + np.random.RandomState(seed).normal(scale=noise, size=x.shape)).ravel()
+
+
+def _checkJacobian(obj, x, h=1e-6, seed=2):
+    """
+    Compare the Jacobian of obj at x with central differences along
+    random directions.
+    """
+    J = obj.jacobian(x)
+    assert J.shape == (obj.nResiduals, len(x))
+    rand = np.random.RandomState(seed)
+    for _ in range(3):
+        v = rand.normal(size=len(x))
+        fd = (obj(x + h * v).copy() - obj(x - h * v).copy()) / (2.0 * h)
+        np.testing.assert_allclose(J.dot(v), fd, rtol=1e-4, atol=1e-6 * np.abs(fd).max())
+
+
+@pytest.mark.parametrize('mode', ['DPEP', 'EPDP', '2way'])
+@pytest.mark.parametrize('options', [{}, {'nClosestPoints': 3}, {'trimFraction': 0.1},
+                                     {'weights': np.linspace(0.5, 2.0, 200)}])
+def test_data_objective_jacobian(mode, options):
+    gf = _mesh()
+    obj = objectives.DataObjective(gf, benchmark.makePointCloud(200), [4, 4], mode, **options)
+    _checkJacobian(obj, _params(gf))
+
+
+def test_data_objective_elements_jacobian():
+    gf = _mesh()
+    obj = objectives.DataObjective(gf, benchmark.makePointCloud(200), [4, 4], 'EPDP', elements=[0, 1])
+    assert obj.nResiduals == 2 * 16
+    _checkJacobian(obj, _params(gf))
+
+
+def test_data_objective_holds_inliers_until_updated():
+    gf = _mesh()
+    obj = objectives.DataObjective(gf, benchmark.makePointCloud(200), [4, 4], 'DPEP', trimFraction=0.2)
+    x = _params(gf)
+    obj(x)
+    inliers = obj.inliers.copy()
+    assert inliers.sum() == 160
+    y = _params(gf, noise=1.0, seed=3)
+    obj(y)
+    np.testing.assert_array_equal(obj.inliers, inliers)
+    obj.updateInliers(y)
+    assert obj.inliers.sum() == 160
+    assert (obj.inliers != inliers).any()
+    assert (obj(y)[~obj.inliers] == 0.0).all()
+
+def test_sobolev_penalty_jacobian():
+    gf = _mesh()
+    _checkJacobian(objectives.SobolevPenalty(gf, [4, 4], [1.0, 2.0, 3.0, 4.0, 5.0]), _params(gf))
+
+
+def test_normal_penalty_jacobian():
+    gf = _mesh()
+    _checkJacobian(objectives.NormalPenalty(gf, 4), _params(gf))
+
+
+@pytest.mark.parametrize('mode', ['DPEP', 'EPDP', '2way'])
+def test_data_objective_float32_shares_data(mode):
+    gf = _mesh()
+    data = np.ascontiguousarray(benchmark.makePointCloud(200))
+    x = _params(gf)
+    obj = objectives.DataObjective(gf, data, [4, 4], mode, dtype=np.float32)
+    obj64 = objectives.DataObjective(gf, data, [4, 4], mode)
+    assert obj.data is data
+    if obj.dataTree is not None:
+        assert np.shares_memory(obj.dataTree.data, data)
+    J = obj.jacobian(x)
+    assert J.dtype == np.float32
+    np.testing.assert_allclose(obj(x), obj64(x), rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(J.toarray(), obj64.jacobian(x).toarray(), rtol=1e-3, atol=1e-3)
+
+@needsGias3Fields
+@pytest.mark.parametrize('mode', ['DPEP', 'EPDP', '2way'])
+def test_data_objective_matches_gias3(mode):
+    from gias3.fieldwork.field import geometric_field_fitter as GFF
+    makeObj = {'DPEP': GFF.makeObjDPEP, 'EPDP': GFF.makeObjEPDP, '2way': GFF.makeObj2Way}[mode]
+    gf = _mesh()
+    data = benchmark.makePointCloud(200)
+    x = _params(gf)
+    expected = makeObj(gf, data, [4, 4])(x.reshape((3, -1)))
+    np.testing.assert_allclose(objectives.DataObjective(gf, data, [4, 4], mode)(x), expected, atol=1e-10)
+
+
+@needsGias3Fields
+def test_sobolev_penalty_matches_gias3():
+    from gias3.fieldwork.field import geometric_field_fitter as GFF
+    gf = _mesh()
+    x = _params(gf)
+    w = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+    expected = GFF.makeSobelovPenalty2D(gf, [4, 4], w)(x.reshape((3, -1)))
+    np.testing.assert_allclose(objectives.SobolevPenalty(gf, [4, 4], w)(x), expected, rtol=1e-10)
+
+
+@needsGias3Fields
+def test_normal_penalty_matches_gias3():
+    from gias3.fieldwork.field import geometric_field_fitter as GFF
+    gf = _mesh()
+    x = _params(gf)
+    expected = GFF.normalSmoother2(gf.ensemble_field_function.flatten()[0]).makeObj(4)(x.reshape((3, -1)))
+    np.testing.assert_allclose(objectives.NormalPenalty(gf, 4)(x), expected, atol=1e-10)
+
+
+def _fit(mesh=(8, 3), **values):
+    config = dict(fitting.FIT_CONFIG_DEFAULTS)
+    config.update({'verbose': 'False', 'max iterations': '3', 'slave mesh discretisation': '[4,4]'})
+    config.update(values)
+    args = fitting.FitConfig(config)
+    slaveGF = benchmark.makeSlaveMesh(*mesh)
+    data = benchmark.makePointCloud(2000)
+    x0 = slaveGF.get_field_parameters().copy()
+    RMSE0 = np.sqrt(fitting.makeDataObj(slaveGF, data, args)(x0.ravel(), weighted=False).mean())
+    hostGF = fitting.makeHostGF(slaveGF, args['host element type'])
+    RMSEs = []
+    result = fitting.hostMeshFit(data, slaveGF, hostGF, args, callback=lambda *progress: RMSEs.append(progress[3]))
+    return x0, RMSE0, RMSEs, result
+
+
+@needsGias3Fields
+@pytest.mark.parametrize('mesh, values', [
+    ((8, 3), {'fit mode': 'ICP'}),
+    ((8, 3), {'fit mode': 'EPDP', 'analytic jacobian': 'True'}),
+    # a full ICP step on this coarse case throws the host mesh out
+    ((4, 1), {'fit mode': 'ICP', 'max iterations': '10'}),
+])
+def test_host_mesh_fit_returns_best_fit(mesh, values):
+    x0, RMSE0, RMSEs, (hostParams, slaveParams, slaveXi, RMSE, fitErrors) = _fit(mesh, **values)
+    assert slaveParams.shape == x0.shape
+    assert np.isfinite(RMSE)
+    assert RMSE < RMSE0
+    # the penalties can trade a little data error, but the fit must not
+    # end far from the best it reached
+    assert RMSE <= 1.01 * min(RMSEs)
+
+
+@needsGias3Fields
+def test_host_mesh_fit_elements_fixes_other_nodes():
+    x0, RMSE0, RMSEs, (hostParams, slaveParams, slaveXi, RMSE, fitErrors) = _fit(
+        **{'fit mode': 'ICP', 'fit elements': '[0,1]'})
+    fitted = np.zeros(x0.shape[1], dtype=bool)
+    fitted[basis.elementsNodes(benchmark.makeSlaveMesh(), [0, 1])] = True
+    moved = np.abs(slaveParams - x0).max(0).ravel() > 1e-12
+    assert moved[fitted].any()
+    assert not moved[~fitted].any()